@@ -0,0 +1,77 @@
+"""Бенчмарк выбора строк для геокодирования и записи координат обратно.
+
+Сравнивает старый обход iterrows() с поячеечной записью .at[] и векторный
+путь ExcelHandler.pending_addresses / set_coordinates на синтетическом листе
+(новый путь пишет ещё и числовые Широта/Долгота, статус и точность).
+
+Запуск: python api/benchmarks/bench_row_selection.py [число строк]
+"""
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'docker'))
+
+from excel_geocoder.excel import ExcelHandler
+
+
+def make_dataframe(rows):
+    """Лист с адресами: 5% пустых адресов, треть строк уже с координатами."""
+    rng = np.random.default_rng(0)
+    addresses = pd.Series([f"г. Москва, ул. Тестовая, д. {i}" for i in range(rows)], dtype=object)
+    addresses[rng.random(rows) < 0.05] = None
+    coordinates = pd.Series([None] * rows, dtype=object)
+    filled = rng.random(rows) < 0.33
+    coordinates[filled] = "55.75, 37.61"
+    return pd.DataFrame({'Адрес': addresses, 'Координаты': coordinates})
+
+
+def iterrows_select(dataframe):
+    """Выбор строк так, как это делал /process до векторизации."""
+    pending = []
+    for index, row in dataframe.iterrows():
+        address = row.get('Адрес')
+        if pd.isna(address):
+            continue
+        if pd.notna(dataframe.at[index, 'Координаты']):
+            continue
+        pending.append((index, address))
+    return pending
+
+
+def cell_write(dataframe, coordinates):
+    for index, value in coordinates.items():
+        dataframe.at[index, 'Координаты'] = value
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    handler = ExcelHandler(None)
+
+    handler.dataframe = make_dataframe(rows)
+    old_pending, old_select = timed(iterrows_select, handler.dataframe)
+    handler.add_coordinates_column('Координаты')
+    handler.migrate_coordinates('Координаты')
+    new_pending, new_select = timed(handler.pending_addresses, 'Адрес')
+    assert old_pending == new_pending
+
+    indices = [index for index, _ in new_pending]
+    _, old_write = timed(cell_write, handler.dataframe.copy(), dict.fromkeys(indices, "55.75, 37.61"))
+    _, new_write = timed(handler.set_coordinates, dict.fromkeys(indices, (55.75, 37.61, 'exact')), 'Координаты')
+
+    print(f"Строк: {rows}, к геокодированию: {len(new_pending)}")
+    print(f"Выбор строк:  iterrows {old_select:.3f} с, маска {new_select:.3f} с, x{old_select / new_select:.0f}")
+    print(f"Запись:       .at[]    {old_write:.3f} с, .loc  {new_write:.3f} с, x{old_write / new_write:.0f}")
+
+
+if __name__ == '__main__':
+    main()
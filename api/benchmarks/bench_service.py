@@ -0,0 +1,202 @@
+"""Сквозной бенчмарк /upload + /process на макете геокодера.
+
+Генерирует синтетические листы (по умолчанию 1k/10k/100k строк с долей
+повторяющихся адресов), запускает MockGeocoder отдельным процессом (чтобы
+макет не делил event loop с сервисом), поднимает приложение в текущем
+процессе и для каждого размера несколько раз выполняет /upload и
+/process в чистом рабочем каталоге (пустые кэши). Печатает пропускную
+способность и перцентили задержек и сохраняет их в JSON, чтобы сравнивать
+прогоны между изменениями.
+
+Запуск: python api/benchmarks/bench_service.py --sizes 1000 10000 --repeat 3
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import aiohttp
+import pandas as pd
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+DOCKER_DIR = os.path.join(BENCHMARKS_DIR, '..', 'docker')
+
+STREETS = ['Ленина', 'Тверская', 'Арбат', 'Мира', 'Садовая', 'Гагарина', 'Пушкина', 'Лесная', 'Новая', 'Центральная']
+STREET_TYPES = ['ул.', 'улица', 'пр-т', 'проспект', 'пер.']
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Бенчмарк /upload + /process')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000], help='размеры листов, строк')
+    parser.add_argument('--repeat', type=int, default=3, help='прогонов на каждый размер')
+    parser.add_argument('--duplicates', type=float, default=0.3, help='доля строк-повторов')
+    parser.add_argument('--concurrency', type=int, default=50, help='одновременных запросов к геокодеру')
+    parser.add_argument('--latency', type=float, default=0.05, help='задержка макета, сек')
+    parser.add_argument('--jitter', type=float, default=0.01)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--rate-429', type=float, default=0.0)
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='bench_service.json', help='куда сохранить результаты')
+    return parser.parse_args()
+
+
+def make_sheet(path, rows, duplicates, seed):
+    """Лист с колонкой Адрес; повторы отличаются оформлением, как в реальных данных."""
+    rng = random.Random(seed)
+    unique = max(1, int(rows * (1 - duplicates)))
+    addresses = [f"г. Москва, {rng.choice(STREET_TYPES)} {rng.choice(STREETS)}, д. {i}" for i in range(unique)]
+    for _ in range(rows - unique):
+        address = rng.choice(addresses)
+        addresses.append(rng.choice([address, address.upper(), f"  {address}‎", address.replace('д.', 'дом')]))
+    rng.shuffle(addresses)
+    pd.DataFrame({'Адрес': addresses}).to_excel(path, index=False)
+
+
+def multipart(path):
+    boundary = 'benchboundary'
+    with open(path, 'rb') as file:
+        content = file.read()
+    name = os.path.basename(path)
+    body = (
+        f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="{name}"\r\n'
+        f'Content-Type: application/octet-stream\r\n\r\n'
+    ).encode() + content + f'\r\n--{boundary}--\r\n'.encode()
+    return body, {'Content-Type': f'multipart/form-data; boundary={boundary}'}
+
+
+def percentile(values, q):
+    ordered = sorted(values)
+    position = (len(ordered) - 1) * q
+    lower = int(position)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+
+
+def summary(values):
+    return {'p50': percentile(values, 0.5), 'p90': percentile(values, 0.9), 'p99': percentile(values, 0.99),
+            'mean': sum(values) / len(values)}
+
+
+async def mock_requests(port):
+    """Сколько запросов получил макет с момента запуска."""
+    async with aiohttp.ClientSession() as session:
+        async with session.get(f'http://127.0.0.1:{port}/stats') as response:
+            return (await response.json())['requests']
+
+
+async def start_mock(args):
+    """Запуск макета отдельным процессом и ожидание готовности порта."""
+    process = subprocess.Popen([
+        sys.executable, os.path.join(BENCHMARKS_DIR, 'mock_yandex.py'), '--port', str(args.port),
+        '--latency', str(args.latency), '--jitter', str(args.jitter), '--error-rate', str(args.error_rate),
+        '--rate-429', str(args.rate_429), '--seed', str(args.seed)
+    ])
+    for _ in range(100):
+        try:
+            await mock_requests(args.port)
+            return process
+        except aiohttp.ClientError:
+            await asyncio.sleep(0.1)
+    process.terminate()
+    raise RuntimeError('Макет геокодера не запустился')
+
+
+async def run_once(service, port, sheet, rows, concurrency):
+    """Один прогон в чистом каталоге: время /upload, /process и число запросов к макету."""
+    requests_before = await mock_requests(port)
+    async with service.app.test_app() as test_app:
+        client = test_app.test_client()
+        body, headers = multipart(sheet)
+
+        start = time.perf_counter()
+        response = await client.post('/upload', data=body, headers=headers)
+        upload_seconds = time.perf_counter() - start
+        assert response.status_code == 200, await response.get_data()
+        file_path = (await response.get_json())['file_path']
+
+        start = time.perf_counter()
+        response = await client.post('/process', json={'addresses': file_path, 'apikey': 'apikey.txt',
+                                                       'concurrency': concurrency})
+        process_seconds = time.perf_counter() - start
+        assert response.status_code == 200, await response.get_data()
+
+        return {'upload_seconds': upload_seconds, 'process_seconds': process_seconds,
+                'rows_per_second': rows / process_seconds,
+                'upstream_requests': await mock_requests(port) - requests_before}
+
+
+async def main():
+    args = parse_args()
+    output = os.path.abspath(args.output)
+    workdir = tempfile.mkdtemp(prefix='bench_service_')
+    sheets_dir = os.path.join(workdir, 'sheets')
+    os.makedirs(sheets_dir)
+
+    # Конфигурация сервиса читается при импорте, поэтому задаётся до него
+    os.environ.update({
+        'GEOCODER_URL': f'http://127.0.0.1:{args.port}/1.x/',
+        'GEOCODER_RATE': '1000000',
+        'GEOCODER_BURST': '1000000',
+        'GEOCODER_DAILY_LIMIT': '1000000000',
+        'MAX_REQUESTS': '1000000000',
+        'GEOCODER_POOL_SIZE': str(args.concurrency),
+    })
+    sys.path.insert(0, DOCKER_DIR)
+
+    mock = await start_mock(args)
+    results = {'config': vars(args), 'runs': {}}
+    try:
+        for rows in args.sizes:
+            sheet = os.path.join(sheets_dir, f'sheet_{rows}.xlsx')
+            make_sheet(sheet, rows, args.duplicates, args.seed)
+            runs = []
+            for attempt in range(args.repeat):
+                # Чистый каталог на каждый прогон: пустые кэш, контрольные точки и загрузки
+                run_dir = os.path.join(workdir, f'run_{rows}_{attempt}')
+                os.makedirs(run_dir)
+                os.chdir(run_dir)
+                with open('apikey.txt', 'w', encoding='utf-8') as file:
+                    file.write('benchmark')
+                for name in [name for name in sys.modules if name == 'mikroservices' or name.startswith('excel_geocoder')]:
+                    sys.modules.pop(name)
+                import mikroservices as service
+                logging.getLogger().setLevel(logging.WARNING)
+
+                runs.append(await run_once(service, args.port, sheet, rows, args.concurrency))
+                print(f"{rows:>7} строк, прогон {attempt + 1}: /upload {runs[-1]['upload_seconds']:.3f} с, "
+                      f"/process {runs[-1]['process_seconds']:.3f} с, {runs[-1]['rows_per_second']:.0f} строк/с")
+
+            results['runs'][rows] = {
+                'upload_seconds': summary([run['upload_seconds'] for run in runs]),
+                'process_seconds': summary([run['process_seconds'] for run in runs]),
+                'rows_per_second': summary([run['rows_per_second'] for run in runs]),
+                'upstream_requests': runs[-1]['upstream_requests'],
+            }
+    finally:
+        mock.terminate()
+        mock.wait()
+        os.chdir(os.path.dirname(output))
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print()
+    print(f"{'строк':>7} {'upload p50':>11} {'process p50':>12} {'process p90':>12} {'process p99':>12} {'строк/с':>9}")
+    for rows, run in results['runs'].items():
+        print(f"{rows:>7} {run['upload_seconds']['p50']:>11.3f} {run['process_seconds']['p50']:>12.3f} "
+              f"{run['process_seconds']['p90']:>12.3f} {run['process_seconds']['p99']:>12.3f} "
+              f"{run['rows_per_second']['p50']:>9.0f}")
+
+    with open(output, 'w', encoding='utf-8') as file:
+        json.dump(results, file, ensure_ascii=False, indent=2)
+    print(f"Результаты сохранены: {output}")
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
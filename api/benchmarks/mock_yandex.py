@@ -0,0 +1,103 @@
+"""Локальный макет Yandex Geocoder API (geocode-maps.yandex.ru/1.x/) для бенчмарков.
+
+Отвечает в формате GeoObjectCollection.featureMember, координаты выводятся
+из адреса детерминированно. Задержка, доля ошибок 5xx, доля 429 и доля
+"не найдено" настраиваются; случайность задаётся seed, поэтому прогоны
+воспроизводимы.
+
+Запуск отдельно: python api/benchmarks/mock_yandex.py --port 8080 --latency 0.05
+"""
+import argparse
+import asyncio
+import hashlib
+import random
+
+from aiohttp import web
+
+
+class MockGeocoder:
+    def __init__(self, latency=0.05, jitter=0.0, error_rate=0.0, rate_429=0.0, not_found_rate=0.0, seed=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rate_429 = rate_429
+        self.not_found_rate = not_found_rate
+        self.random = random.Random(seed)
+        self.requests = 0
+
+    @staticmethod
+    def position(address):
+        """Детерминированные координаты адреса в пределах Москвы."""
+        digest = hashlib.md5(address.encode('utf-8')).digest()
+        lon = 37.3 + int.from_bytes(digest[:4], 'big') / 2 ** 32 * 0.6
+        lat = 55.55 + int.from_bytes(digest[4:8], 'big') / 2 ** 32 * 0.4
+        return lon, lat
+
+    async def handle(self, request):
+        self.requests += 1
+        address = request.query.get('geocode', '')
+        delay = max(0.0, self.random.gauss(self.latency, self.jitter)) if self.jitter else self.latency
+        roll = self.random.random()
+        await asyncio.sleep(delay)
+
+        if roll < self.rate_429:
+            return web.json_response({'message': 'Too Many Requests'}, status=429, headers={'Retry-After': '1'})
+        if roll < self.rate_429 + self.error_rate:
+            return web.json_response({'message': 'Internal Server Error'}, status=500)
+
+        members = []
+        if roll >= self.rate_429 + self.error_rate + self.not_found_rate:
+            lon, lat = self.position(address)
+            members.append({
+                'GeoObject': {
+                    'metaDataProperty': {'GeocoderMetaData': {'precision': 'exact', 'text': address}},
+                    'name': address,
+                    'Point': {'pos': f"{lon:.6f} {lat:.6f}"}
+                }
+            })
+        return web.json_response({
+            'response': {
+                'GeoObjectCollection': {
+                    'metaDataProperty': {
+                        'GeocoderResponseMetaData': {'request': address, 'found': str(len(members)), 'results': '10'}
+                    },
+                    'featureMember': members
+                }
+            }
+        })
+
+    async def stats(self, request):
+        return web.json_response({'requests': self.requests})
+
+    def application(self):
+        app = web.Application()
+        app.router.add_get('/1.x/', self.handle)
+        app.router.add_get('/stats', self.stats)
+        return app
+
+    async def start(self, host='127.0.0.1', port=8080):
+        """Запуск в текущем event loop; возвращает runner для остановки."""
+        runner = web.AppRunner(self.application(), access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        return runner
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Макет Yandex Geocoder API')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--latency', type=float, default=0.05, help='средняя задержка ответа, сек')
+    parser.add_argument('--jitter', type=float, default=0.0, help='стандартное отклонение задержки, сек')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='доля ответов 500')
+    parser.add_argument('--rate-429', type=float, default=0.0, help='доля ответов 429')
+    parser.add_argument('--not-found-rate', type=float, default=0.0, help='доля пустых featureMember')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    mock = MockGeocoder(args.latency, args.jitter, args.error_rate, args.rate_429, args.not_found_rate, args.seed)
+    web.run_app(mock.application(), host=args.host, port=args.port, access_log=None, print=None)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,17 @@
 from flask import Flask, jsonify, request, send_file
-import pandas as pd
-import requests
+import asyncio
+import atexit
 import os
+import sys
+import threading
 from werkzeug.utils import secure_filename
 
+# Геокодирование и работа с Excel - общий пакет excel_geocoder из api/docker
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'docker'))
+import excel_geocoder as core
+from excel_geocoder import executor
+from excel_geocoder.files import file_sha256, write_fingerprint
+
 app = Flask(__name__)
 
 UPLOAD_FOLDER = 'uploads'
@@ -18,80 +26,48 @@ def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
 
-class ExcelHandler:
-    def __init__(self, file_path):
-        self.file_path = file_path
-        self.dataframe = None
-
-    def read_excel(self):
-        """Чтение Excel файла и сохранение данных в dataframe."""
-        try:
-            self.dataframe = pd.read_excel(self.file_path)
-            print("Excel файл успешно прочитан.")
-        except FileNotFoundError:
-            raise Exception(f"Файл {self.file_path} не найден.")
-        except Exception as e:
-            raise Exception(f"Ошибка при чтении файла: {str(e)}")
-
-    def add_coordinates_column(self, coordinates_column_name):
-        """Добавление новой колонки с координатами."""
-        if self.dataframe is not None:
-            if coordinates_column_name not in self.dataframe.columns:
-                self.dataframe[coordinates_column_name] = None
-                print(f"Колонка '{coordinates_column_name}' добавлена.")
-            else:
-                print(f"Колонка '{coordinates_column_name}' уже существует.")
-        else:
-            raise Exception("Dataframe не загружен. Сначала вызовите метод read_excel.")
-
-    def save_excel(self):
-        """Сохранение Excel файла с изменениями в тот же файл."""
-        try:
-            self.dataframe.to_excel(self.file_path, index=False)
-            print(f"Файл успешно сохранен: {self.file_path}")
-        except Exception as e:
-            raise Exception(f"Ошибка при сохранении Excel файла: {str(e)}")
-
-
-class AddressGeocoder:
-    def __init__(self, api_key_file):
-        self.api_key = self.get_api_key(api_key_file)
-
-    def get_api_key(self, file_path):
-        """Чтение API ключа из файла."""
-        try:
-            with open(file_path, 'r', encoding='utf-8') as file:
-                api_key = file.read().strip()
-            return api_key
-        except FileNotFoundError:
-            raise Exception(f"Файл {file_path} не найден.")
-        except Exception as e:
-            raise Exception(f"Ошибка чтения API ключа: {str(e)}")
-
-    def get_coordinates(self, address):
-        """Получение координат по адресу с использованием Yandex Geocoder API."""
-        url = 'https://geocode-maps.yandex.ru/1.x/'
-        params = {
-            'geocode': address,
-            'format': 'json',
-            'apikey': self.api_key
-        }
-
-        try:
-            response = requests.get(url, params=params, timeout=10)
-            response.raise_for_status()
-            data = response.json()
-
-            if 'response' in data and data['response']['GeoObjectCollection']['featureMember']:
-                pos = data['response']['GeoObjectCollection']['featureMember'][0]['GeoObject']['Point']['pos']
-                lon, lat = map(float, pos.split())
-                return lat, lon
-            else:
-                print(f"Координаты не найдены для адреса: {address}")
-                return None, None
-        except requests.exceptions.RequestException as e:
-            print(f"Ошибка при запросе к API для адреса {address}: {str(e)}")
-            return None, None
+# Ресурсы геокодера (сессия aiohttp, кэш, ограничитель частоты, пул ключей) общие
+# для процесса и привязаны к одному event loop, а Flask обслуживает запросы в
+# потоках. Поэтому loop один на процесс: он работает в фоновом потоке, ресурсы
+# открываются в нём при первом запросе и закрываются при выходе
+loop = None
+loop_lock = threading.Lock()
+
+
+async def close_resources():
+    await core.close_geocoder()
+    core.CheckpointStore.close_shared()
+    core.BaseSnapshots.close_shared()
+    executor.close_executor()
+
+
+def close_loop():
+    global loop
+    with loop_lock:
+        if loop is None:
+            return
+        asyncio.run_coroutine_threadsafe(close_resources(), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+        loop = None
+
+
+def run(coroutine):
+    """Выполнение корутины в общем event loop; поток запроса ждёт результата."""
+    global loop
+    with loop_lock:
+        if loop is None:
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name='geocoder-loop', daemon=True).start()
+            asyncio.run_coroutine_threadsafe(core.open_geocoder(), loop).result()
+            atexit.register(close_loop)
+    return asyncio.run_coroutine_threadsafe(coroutine, loop).result()
+
+
+async def process_file(file_path, api_key_file, max_requests):
+    """Обработка файла в общем loop. Геокодер создаётся здесь, а не в потоке
+    запроса: run уже открыл ресурсы, и провайдеры получают общий ограничитель частоты."""
+    geocoder = core.AddressGeocoder(api_key_file)
+    return await core.geocode_file(file_path, geocoder, max_requests=max_requests, export=True)
 
 
 @app.route('/upload', methods=['POST'])
@@ -108,6 +84,8 @@ def upload_file():
         filename = secure_filename(file.filename)
         file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
         file.save(file_path)
+        # Хэш загрузки: по нему движок находит контрольные точки и колоночную копию этого файла
+        write_fingerprint(file_path, file_sha256(file_path))
         return jsonify({'message': 'Файл загружен', 'file_path': file_path}), 200
 
     return jsonify({'error': 'Недопустимый формат файла. Разрешены только .xlsx файлы.'}), 400
@@ -124,45 +102,9 @@ def process_addresses():
     if not file_path or not os.path.exists(file_path):
         return jsonify({'error': 'Неверный путь к файлу.'}), 400
 
-    # Создаем экземпляры классов
-    excel_handler = ExcelHandler(file_path)
-    geocoder = AddressGeocoder(api_key_file)
-
-    # Чтение Excel файла
-    try:
-        excel_handler.read_excel()
-    except Exception as e:
-        return jsonify({'error': str(e)}), 500
-
-    # Добавление столбца для координат
-    coordinates_column_name = 'Координаты'
-    try:
-        excel_handler.add_coordinates_column(coordinates_column_name)
-    except Exception as e:
-        return jsonify({'error': str(e)}), 500
-
-    # Обрабатываем каждый адрес
-    request_count = 0
-    for index, row in excel_handler.dataframe.iterrows():
-        address = row.get('Адрес')
-        if pd.isna(address):
-            continue
-
-        if pd.notna(excel_handler.dataframe.at[index, coordinates_column_name]):
-            continue
-
-        if request_count >= max_requests_per_day:
-            break
-
-        latitude, longitude = geocoder.get_coordinates(address)
-        if latitude is not None and longitude is not None:
-            excel_handler.dataframe.at[index, coordinates_column_name] = f"{latitude}, {longitude}"
-            request_count += 1
-
-    # Сохранение файла
     try:
-        excel_handler.save_excel()
-        return jsonify({'message': 'Файл успешно обработан', 'file_path': file_path}), 200
+        stats = run(process_file(file_path, api_key_file, max_requests_per_day))
+        return jsonify({'message': 'Файл успешно обработан', 'file_path': file_path, **stats}), 200
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -174,7 +116,9 @@ def download_file():
     if not file_path or not os.path.exists(file_path):
         return jsonify({'error': 'Файл не найден'}), 400
 
-    return send_file(file_path, as_attachment=True)
+    run(core.export_file(file_path))
+    # conditional: ETag и Last-Modified с ответом 304, Range для докачки
+    return send_file(file_path, as_attachment=True, conditional=True)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,54 @@
+"""Геокодирование адресов из книг Excel: общий движок для HTTP сервиса и командной строки.
+
+Имена пакета загружаются при первом обращении (PEP 562): ``import
+excel_geocoder`` не тянет pandas, NumPy и openpyxl, их импортируют только
+excel и spatial, когда дело доходит до книг или индекса.
+"""
+import importlib
+
+# Имя -> подмодуль, из которого оно берётся
+_EXPORTS = {
+    'AddressGeocoder': 'engine',
+    'geocode_stream': 'engine',
+    'open_geocoder': 'engine',
+    'close_geocoder': 'engine',
+    'ProviderUnavailable': 'providers',
+    'QuotaExhausted': 'providers',
+    'YandexProvider': 'providers',
+    'NominatimProvider': 'providers',
+    'GazetteerProvider': 'providers',
+    'GeocodeCache': 'storage',
+    'RateLimiter': 'storage',
+    'KeyPool': 'storage',
+    'CheckpointStore': 'storage',
+    'BaseSnapshots': 'storage',
+    'clean_address': 'addresses',
+    'normalize_address': 'addresses',
+    'group_addresses': 'addresses',
+    'address_fingerprint': 'addresses',
+    'file_fingerprint': 'files',
+    'ExcelHandler': 'excel',
+    'StreamingWorkbook': 'excel',
+    'parse_coordinates': 'excel',
+    'geocode_file': 'excel',
+    'export_file': 'excel',
+    'SpatialIndex': 'spatial',
+    'haversine_km': 'spatial',
+    'Timing': 'timing',
+    'stage': 'timing',
+}
+
+__all__ = list(_EXPORTS)
+
+
+def __getattr__(name):
+    module = _EXPORTS.get(name)
+    if module is None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(f'.{module}', __name__), name)
+    globals()[name] = value  # Следующие обращения идут мимо __getattr__
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_EXPORTS))
@@ -0,0 +1,77 @@
+"""Очистка, нормализация и группировка адресов."""
+import hashlib
+import re
+
+
+# Невидимые символы, которые попадают в адреса при копировании из браузера
+INVISIBLE_CHARS = dict.fromkeys(map(ord, '\u200e\u200f\u200b\u2060\ufeff'), None)
+
+# Канонические сокращения адресных элементов (ключи без точки на конце)
+ADDRESS_ABBREVIATIONS = {
+    'город': 'г', 'гор': 'г',
+    'область': 'обл',
+    'район': 'р-н',
+    'поселок': 'п', 'пос': 'п',
+    'улица': 'ул',
+    'проспект': 'пр-кт', 'пр-т': 'пр-кт', 'просп': 'пр-кт',
+    'переулок': 'пер',
+    'площадь': 'пл',
+    'бульвар': 'б-р', 'бул': 'б-р',
+    'шоссе': 'ш',
+    'набережная': 'наб',
+    'проезд': 'пр-д',
+    'микрорайон': 'мкр',
+    'дом': 'д',
+    'корпус': 'к', 'корп': 'к',
+    'строение': 'стр',
+    'квартира': 'кв',
+}
+
+
+def clean_address(address):
+    """Удаление невидимых символов и лишних пробелов: этот вариант уходит в геокодер."""
+    return ' '.join(str(address).translate(INVISIBLE_CHARS).replace('\xa0', ' ').split())
+
+
+def normalize_address(address):
+    """Приведение адреса к каноническому ключу: регистр, пробелы, ё, сокращения.
+
+    Адреса, отличающиеся только оформлением ("ул. Ленина, д.5" и
+    "улица  Ленина, дом 5"), получают одинаковый ключ.
+    """
+    text = clean_address(address).lower().replace('ё', 'е')
+    text = re.sub(r'\.(?=\S)', '. ', text)  # "ул.Ленина" -> "ул. Ленина"
+    parts = []
+    for part in text.split(','):
+        words = [word.rstrip('.') for word in part.split()]
+        words = [ADDRESS_ABBREVIATIONS.get(word, word) for word in words if word]
+        if words:
+            parts.append(' '.join(words))
+    return ', '.join(parts)
+
+
+def address_fingerprint(address):
+    """Отпечаток адреса строки: хэш нормализованного адреса.
+
+    Не меняется, если адрес поправили только в оформлении, и меняется, если
+    изменился сам адрес.
+    """
+    return hashlib.blake2b(normalize_address(address).encode('utf-8'), digest_size=8).hexdigest()
+
+
+def group_addresses(rows, limit=None):
+    """Группировка строк с одинаковым нормализованным адресом.
+
+    rows - пары (индекс строки, адрес). Возвращает список пар
+    (адрес для запроса, [индексы строк]) в порядке первого появления;
+    limit ограничивает число уникальных адресов, то есть запросов.
+    """
+    groups = {}
+    for index, address in rows:
+        key = normalize_address(address)
+        if key not in groups:
+            if limit is not None and len(groups) >= limit:
+                break
+            groups[key] = (clean_address(address), [])
+        groups[key][1].append(index)
+    return list(groups.values())
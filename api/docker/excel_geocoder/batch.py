@@ -0,0 +1,212 @@
+"""Пакетная обработка каталогов книг xlsx и csv без HTTP сервиса.
+
+Книги разбираются и записываются в пуле процессов, а адреса всех книг
+геокодируются в одном event loop главного процесса: одинаковые после
+нормализации адреса из разных файлов запрашиваются один раз. Результат
+пишется рядом с исходным файлом: <имя>.geocoded.xlsx.
+"""
+import asyncio
+import glob
+import logging
+import os
+import shutil
+import tempfile
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+
+from .addresses import group_addresses, normalize_address
+from .excel import ExcelHandler
+
+BATCH_EXTENSIONS = ('.xlsx', '.csv')
+BATCH_SUFFIX = '.geocoded'  # Добавляется к имени файла результата
+
+
+def expand_paths(patterns, suffix=BATCH_SUFFIX):
+    """Книги из списка файлов, каталогов и шаблонов glob.
+
+    Результаты прошлых запусков (с suffix в имени) и временные файлы Excel
+    (~$...) пропускаются; порядок стабильный, повторы убираются.
+    """
+    paths = []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            candidates = [os.path.join(pattern, name) for name in os.listdir(pattern)]
+        else:
+            # Несуществующий файл остаётся в списке, чтобы попасть в отчёт с ошибкой
+            candidates = glob.glob(pattern) or [pattern]
+        for path in sorted(candidates):
+            stem, extension = os.path.splitext(path)
+            if extension.lower() in BATCH_EXTENSIONS and not stem.endswith(suffix) and not os.path.basename(path).startswith('~$'):
+                paths.append(path)
+    return list(dict.fromkeys(paths))
+
+
+def output_path(path, output_dir=None, suffix=BATCH_SUFFIX):
+    """Путь результата: рядом с исходным файлом или в output_dir."""
+    stem, extension = os.path.splitext(os.path.basename(path))
+    return os.path.join(output_dir or os.path.dirname(path), f"{stem}{suffix}{extension}")
+
+
+def read_table(path, address_column_name, spool_dir, sep=',', encoding='utf-8'):
+    """Чтение книги в процессе пула.
+
+    Подготовленная таблица (колонки результата, перенесённые старые
+    координаты) сохраняется в spool_dir в pickle, чтобы при записи не
+    разбирать xlsx второй раз. В главный процесс возвращаются только адреса
+    строк без координат.
+    """
+    start = time.perf_counter()
+    if path.lower().endswith('.csv'):
+        dataframe = pd.read_csv(path, sep=sep, encoding=encoding)
+    else:
+        dataframe = pd.read_excel(path)
+    excel_handler = ExcelHandler(path)
+    excel_handler.dataframe = dataframe
+    excel_handler.add_coordinates_column('Координаты')
+    excel_handler.migrate_coordinates('Координаты')
+    pending = [(int(index), address) for index, address in excel_handler.pending_addresses(address_column_name)]
+    spool_path = os.path.join(spool_dir, f"{uuid.uuid4().hex}.pkl")
+    excel_handler.dataframe.to_pickle(spool_path)
+    return {'rows': len(excel_handler.dataframe), 'pending': pending, 'spool_path': spool_path,
+            'read_seconds': time.perf_counter() - start}
+
+
+def write_table(spool_path, path, results, sep=',', encoding='utf-8'):
+    """Запись результата в процессе пула; файл заменяется атомарно. Возвращает время записи, сек."""
+    start = time.perf_counter()
+    excel_handler = ExcelHandler(path)
+    excel_handler.dataframe = pd.read_pickle(spool_path)
+    excel_handler.set_coordinates(results, 'Координаты')
+    directory, name = os.path.split(path)
+    temp_path = os.path.join(directory, f".{uuid.uuid4().hex}.{name}")
+    try:
+        if path.lower().endswith('.csv'):
+            excel_handler.dataframe.to_csv(temp_path, index=False, sep=sep, encoding=encoding)
+        else:
+            excel_handler.dataframe.to_excel(temp_path, index=False, engine='openpyxl')
+        os.replace(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        os.remove(spool_path)
+    return time.perf_counter() - start
+
+
+class BatchRun:
+    """Один пакетный запуск: общий пул процессов, общий семафор запросов
+    и общий словарь адрес -> задача геокодирования для всех книг.
+
+    max_requests ограничивает число уникальных адресов за весь запуск
+    (0 - без ограничения); строки сверх лимита, как и строки, по которым не
+    ответил ни один провайдер, остаются без координат и берутся следующим запуском.
+    """
+
+    def __init__(self, geocoder, workers=None, concurrency=10, max_requests=0, address_column_name='Адрес',
+                 output_dir=None, suffix=BATCH_SUFFIX, sep=',', encoding='utf-8'):
+        self.geocoder = geocoder
+        self.workers = workers or os.cpu_count()
+        self.semaphore = asyncio.Semaphore(max(1, concurrency))
+        self.max_requests = max_requests
+        self.address_column_name = address_column_name
+        self.output_dir = output_dir
+        self.suffix = suffix
+        self.sep = sep
+        self.encoding = encoding
+        self.lookups = {}  # Нормализованный адрес -> задача запроса, общая для всех книг
+        self.pool = None
+        self.spool_dir = None
+
+    async def lookup(self, address):
+        async with self.semaphore:
+            return await self.geocoder.try_locate(address)
+
+    async def geocode_rows(self, pending):
+        """Координаты для строк книги: индекс -> (широта, долгота, точность).
+
+        Возвращает результаты и число отложенных строк: сверх лимита запросов
+        или без ответа провайдеров.
+        """
+        tasks = []
+        skipped = 0
+        for position, (address, indices) in enumerate(group_addresses(pending)):
+            key = normalize_address(address)
+            if key not in self.lookups:
+                if self.max_requests and len(self.lookups) >= self.max_requests:
+                    skipped += len(indices)
+                    continue
+                self.lookups[key] = asyncio.ensure_future(self.lookup(address))
+            tasks.append((self.lookups[key], indices))
+        results = {}
+        for (_, indices), result in zip(tasks, await asyncio.gather(*(task for task, _ in tasks))):
+            if result is None:
+                skipped += len(indices)
+            else:
+                results.update(dict.fromkeys(indices, result))
+        return results, skipped
+
+    async def process(self, path):
+        """Чтение, геокодирование и запись одной книги; возвращает строку отчёта."""
+        loop = asyncio.get_running_loop()
+        report = {'path': path, 'output': output_path(path, self.output_dir, self.suffix)}
+        start = time.perf_counter()
+        try:
+            table = await loop.run_in_executor(self.pool, read_table, path, self.address_column_name, self.spool_dir,
+                                               self.sep, self.encoding)
+            geocode_start = time.perf_counter()
+            results, skipped = await self.geocode_rows(table['pending'])
+            geocode_seconds = time.perf_counter() - geocode_start
+            write_seconds = await loop.run_in_executor(self.pool, write_table, table['spool_path'], report['output'],
+                                                       results, self.sep, self.encoding)
+        except Exception as e:
+            logging.error(f"{path}: {str(e)}")
+            report.update(status='failed', error=str(e), seconds=time.perf_counter() - start)
+            return report
+
+        found = sum(1 for latitude, longitude, _ in results.values() if latitude is not None and longitude is not None)
+        seconds = time.perf_counter() - start
+        report.update(status='done', rows=table['rows'], geocoded=len(results), found=found,
+                      not_found=len(results) - found, skipped=skipped, read_seconds=table['read_seconds'],
+                      geocode_seconds=geocode_seconds, write_seconds=write_seconds, seconds=seconds,
+                      rows_per_second=len(results) / seconds if seconds else 0.0)
+        return report
+
+    async def run(self, paths, on_report=None):
+        """Обработка книг; on_report(отчёт) вызывается по готовности каждой. Возвращает итог запуска."""
+        cache = self.geocoder.cache
+        misses_before = cache.misses if cache is not None else 0
+        self.spool_dir = tempfile.mkdtemp(prefix='excel_geocoder_')
+        start = time.perf_counter()
+
+        async def process(path):
+            report = await self.process(path)
+            if on_report is not None:
+                on_report(report)
+            return report
+
+        self.pool = ProcessPoolExecutor(max_workers=self.workers)
+        try:
+            reports = await asyncio.gather(*(process(path) for path in paths))
+        finally:
+            self.pool.shutdown(wait=True)
+            self.pool = None
+            shutil.rmtree(self.spool_dir, ignore_errors=True)
+
+        seconds = time.perf_counter() - start
+        done = [report for report in reports if report['status'] == 'done']
+        geocoded = sum(report['geocoded'] for report in done)
+        return {
+            'files': len(reports),
+            'failed': len(reports) - len(done),
+            'rows': sum(report['rows'] for report in done),
+            'geocoded': geocoded,
+            'found': sum(report['found'] for report in done),
+            'skipped': sum(report['skipped'] for report in done),
+            'unique_addresses': len(self.lookups),
+            'upstream_lookups': (cache.misses - misses_before) if cache is not None else len(self.lookups),
+            'seconds': seconds,
+            'rows_per_second': geocoded / seconds if seconds else 0.0,
+            'reports': reports,
+        }
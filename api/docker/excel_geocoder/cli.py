@@ -0,0 +1,119 @@
+"""Обработка книг из командной строки, без HTTP сервиса и окна выбора файла.
+
+Запуск: python -m excel_geocoder ../excel_f/ 'отчёты/*.csv' --apikey apikey.txt --report nightly.json
+
+По умолчанию книги обрабатываются пакетом (см. batch): результат пишется
+рядом с исходным файлом. С --in-place книги xlsx обновляются на месте по
+одной, с контрольными точками и потоковым режимом, как в /process.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sys
+import time
+
+from . import executor
+from .config import GEOCODER_CONCURRENCY, GEOCODER_KEYS_FILE, MAX_REQUESTS
+from .engine import AddressGeocoder, close_geocoder, open_geocoder
+from .storage import BaseSnapshots, CheckpointStore
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog='excel_geocoder', description='Координаты для колонки "Адрес" книг xlsx и csv')
+    parser.add_argument('paths', nargs='+', help='книги, каталоги или шаблоны glob')
+    parser.add_argument('--apikey', default=GEOCODER_KEYS_FILE, help='файл с ключами Yandex Geocoder')
+    parser.add_argument('--max-requests', type=int, default=None,
+                        help=f'уникальных адресов за запуск, 0 - без ограничения (по умолчанию 0; с --in-place - {MAX_REQUESTS} на книгу)')
+    parser.add_argument('--concurrency', type=int, default=GEOCODER_CONCURRENCY, help='одновременных запросов')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='процессов для чтения и записи книг')
+    parser.add_argument('--column', default='Адрес', help='колонка с адресами')
+    parser.add_argument('--output-dir', help='куда писать результаты; по умолчанию рядом с исходными файлами')
+    parser.add_argument('--suffix', default='.geocoded', help='добавляется к имени файла результата')
+    parser.add_argument('--sep', default=',', help='разделитель csv')
+    parser.add_argument('--encoding', default='utf-8', help='кодировка csv')
+    parser.add_argument('--report', help='сохранить отчёт о запуске в JSON')
+    parser.add_argument('--in-place', action='store_true', help='обновлять книги xlsx на месте, по одной')
+    parser.add_argument('--streaming', action=argparse.BooleanOptionalAction, default=None,
+                        help='с --in-place: потоковая обработка через openpyxl; по умолчанию - по размеру книги')
+    parser.add_argument('--no-resume', dest='resume', action='store_false',
+                        help='с --in-place: начать с первой строки, а не с контрольной точки')
+    parser.add_argument('-v', '--verbose', action='store_true', help='подробный журнал')
+    return parser.parse_args(argv)
+
+
+def print_report(report):
+    if report['status'] != 'done':
+        print(f"{report['path']}: ошибка: {report['error']}")
+        return
+    print(f"{report['path']} -> {report['output']}: строк {report['rows']}, геокодировано {report['geocoded']}, "
+          f"не найдено {report['not_found']}, отложено {report['skipped']}; чтение {report['read_seconds']:.1f} с, "
+          f"геокодирование {report['geocode_seconds']:.1f} с, запись {report['write_seconds']:.1f} с, "
+          f"{report['rows_per_second']:.0f} строк/с")
+
+
+async def run_batch(args, geocoder):
+    """Пакетная обработка; возвращает число книг с ошибкой."""
+    # pandas и openpyxl загружаются здесь, чтобы --help отвечал сразу
+    from .batch import BatchRun, expand_paths
+
+    paths = expand_paths(args.paths, args.suffix)
+    if not paths:
+        logging.error("Не найдено ни одной книги xlsx или csv.")
+        return 1
+    if args.output_dir:
+        os.makedirs(args.output_dir, exist_ok=True)
+    batch = BatchRun(geocoder, args.workers, args.concurrency, args.max_requests or 0, args.column,
+                     args.output_dir, args.suffix, args.sep, args.encoding)
+    summary = await batch.run(paths, print_report)
+
+    print(f"Итого: книг {summary['files']} (с ошибкой {summary['failed']}), строк {summary['rows']}, "
+          f"геокодировано {summary['geocoded']}, найдено {summary['found']}, отложено {summary['skipped']}; "
+          f"уникальных адресов {summary['unique_addresses']}, запросов к провайдерам {summary['upstream_lookups']}; "
+          f"{summary['seconds']:.1f} с, {summary['rows_per_second']:.0f} строк/с")
+    if args.report:
+        with open(args.report, 'w', encoding='utf-8') as file:
+            json.dump(summary, file, ensure_ascii=False, indent=2)
+    return summary['failed']
+
+
+async def run_in_place(args, geocoder):
+    """Последовательная обработка книг xlsx на месте; возвращает число книг с ошибкой."""
+    from .excel import geocode_file
+
+    max_requests = MAX_REQUESTS if args.max_requests is None else args.max_requests or sys.maxsize
+    failed = 0
+    for path in args.paths:
+        start = time.perf_counter()
+        try:
+            stats = await geocode_file(path, geocoder, args.concurrency, max_requests,
+                                       resume=args.resume, export=True, streaming=args.streaming)
+        except Exception as e:
+            logging.error(f"{path}: {str(e)}")
+            failed += 1
+            continue
+        print(f"{path}: запросов {stats['requests']}, строк {stats['rows']}, "
+              f"не найдено {stats['errors']}, отложено {stats['unavailable']}, {time.perf_counter() - start:.1f} с")
+    return failed
+
+
+async def run(args):
+    await open_geocoder()
+    try:
+        geocoder = AddressGeocoder(args.apikey)
+        if args.in_place:
+            return await run_in_place(args, geocoder)
+        return await run_batch(args, geocoder)
+    finally:
+        await close_geocoder()
+        CheckpointStore.close_shared()
+        BaseSnapshots.close_shared()
+        executor.close_executor()
+
+
+def main(argv=None):
+    sys.stdout.reconfigure(encoding='utf-8')
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING, format='%(levelname)s %(message)s')
+    return 1 if asyncio.run(run(args)) else 0
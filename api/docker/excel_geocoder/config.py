@@ -0,0 +1,92 @@
+"""Настройки геокодера, хранилищ и обработки Excel из переменных окружения.
+
+Читаются один раз при импорте и общие для HTTP сервиса и командной строки.
+"""
+import os
+
+
+# Настройки подключения к геокодеру
+GEOCODER_URL = os.environ.get('GEOCODER_URL', 'https://geocode-maps.yandex.ru/1.x/')
+GEOCODER_POOL_SIZE = int(os.environ.get('GEOCODER_POOL_SIZE', 20))  # Максимум соединений в пуле воркера
+GEOCODER_KEEPALIVE = int(os.environ.get('GEOCODER_KEEPALIVE', 30))  # Время жизни простаивающего соединения, сек
+GEOCODER_TIMEOUT = int(os.environ.get('GEOCODER_TIMEOUT', 10))  # Ограничение на ожидание ответа, сек
+GEOCODER_CONCURRENCY = int(os.environ.get('GEOCODER_CONCURRENCY', 10))  # Одновременных запросов на один /process
+MAX_REQUESTS = int(os.environ.get('MAX_REQUESTS', 50))  # Ограничение на количество запросов за один цикл
+
+# Ограничение частоты запросов к геокодеру (token bucket, общий для всех воркеров)
+RATE_LIMIT_PATH = os.environ.get('RATE_LIMIT_PATH', './cache/ratelimit.sqlite3')
+GEOCODER_RATE = float(os.environ.get('GEOCODER_RATE', 10))  # Запросов в секунду
+GEOCODER_BURST = int(os.environ.get('GEOCODER_BURST', 10))  # Ёмкость корзины токенов
+GEOCODER_DAILY_LIMIT = int(os.environ.get('GEOCODER_DAILY_LIMIT', 900))  # Запросов в сутки на ключ, если в файле ключей не указано иное
+GEOCODER_RETRIES = int(os.environ.get('GEOCODER_RETRIES', 3))  # Повторов после 429/5xx
+GEOCODER_BACKOFF_BASE = 1.0  # Первая пауза после 429/5xx, сек
+GEOCODER_BACKOFF_MAX = 60.0  # Максимальная пауза, сек
+
+# Пул API ключей: файл читается один раз на воркер, расход каждого ключа хранится в RATE_LIMIT_PATH
+GEOCODER_KEYS_FILE = os.environ.get('GEOCODER_KEYS_FILE', './apikey.txt')  # Ключи, если запрос не указал свой файл
+GEOCODER_KEY_STRATEGY = os.environ.get('GEOCODER_KEY_STRATEGY', 'round_robin')  # 'round_robin' или 'drain'
+
+# Провайдеры геокодирования в порядке приоритета: yandex, nominatim, gazetteer
+GEOCODER_PROVIDERS = [name.strip() for name in os.environ.get('GEOCODER_PROVIDERS', 'yandex').split(',') if name.strip()]
+GEOCODER_HEDGE_AFTER = float(os.environ.get('GEOCODER_HEDGE_AFTER', 1.0))  # Без ответа дольше - спрашиваем следующего, сек; 0 - не дублировать
+GEOCODER_FAILOVER_COOLDOWN = float(os.environ.get('GEOCODER_FAILOVER_COOLDOWN', 30))  # Сколько отказавший провайдер опрашивается последним, сек
+NOMINATIM_URL = os.environ.get('NOMINATIM_URL', 'https://nominatim.openstreetmap.org/search')
+GAZETTEER_PATH = os.environ.get('GAZETTEER_PATH', './gazetteer.csv')  # CSV: address, latitude, longitude[, precision]
+
+# Потоковая загрузка файлов
+UPLOAD_FOLDER = './uploads'
+UPLOAD_CHUNK_SIZE = int(os.environ.get('UPLOAD_CHUNK_SIZE', 256 * 1024))  # Размер блока записи на диск, байт
+UPLOAD_MAX_SIZE = int(os.environ.get('UPLOAD_MAX_SIZE', 100 * 1024 * 1024))  # Максимальный размер файла, байт
+
+
+# Пул для разбора и записи Excel вне event loop: 'thread' или 'process'
+EXCEL_EXECUTOR = os.environ.get('EXCEL_EXECUTOR', 'thread')
+EXCEL_POOL_SIZE = int(os.environ.get('EXCEL_POOL_SIZE', 2))
+
+# Потоковая обработка больших книг через openpyxl read_only/write_only, без DataFrame в памяти
+EXCEL_STREAM_THRESHOLD = int(os.environ.get('EXCEL_STREAM_THRESHOLD', 20 * 1024 * 1024))  # Книги больше этого - потоково, байт; 0 - никогда
+EXCEL_STREAM_CHUNK = int(os.environ.get('EXCEL_STREAM_CHUNK', 1000))  # Строк в одном куске
+
+# Строковая колонка "Координаты" ("широта, долгота") рядом с числовыми Широта/Долгота для старых потребителей
+EXCEL_LEGACY_COORDINATES = os.environ.get('EXCEL_LEGACY_COORDINATES', '1') == '1'
+
+# Колоночные (Feather) копии загруженных книг: повторные запуски читают их вместо xlsx
+FRAME_CACHE_DIR = os.environ.get('FRAME_CACHE_DIR', './cache/frames')
+
+# Настройки постоянного кэша координат (общий для всех воркеров файл SQLite)
+GEOCODE_CACHE_PATH = os.environ.get('GEOCODE_CACHE_PATH', './cache/geocode.sqlite3')
+GEOCODE_CACHE_TTL = int(os.environ.get('GEOCODE_CACHE_TTL', 30 * 24 * 3600))  # Срок жизни записи, сек
+GEOCODE_CACHE_MAX_ENTRIES = int(os.environ.get('GEOCODE_CACHE_MAX_ENTRIES', 500000))  # Сверх этого вытесняем старые записи
+
+# Фоновые задачи /process: статус хранится в SQLite, общем для всех воркеров
+JOB_STORE_PATH = os.environ.get('JOB_STORE_PATH', './cache/jobs.sqlite3')
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 2))  # Одновременно выполняемых задач на воркер
+JOB_PROGRESS_INTERVAL = 0.5  # Как часто записывать прогресс задачи, сек
+
+# Контрольные точки обработки: результаты сбрасываются пачками, ключ - хэш файла и индекс строки
+CHECKPOINT_PATH = os.environ.get('CHECKPOINT_PATH', './cache/checkpoints.sqlite3')
+CHECKPOINT_BATCH = int(os.environ.get('CHECKPOINT_BATCH', 100))  # Строк в одной пачке
+
+# Снимки прошлых версий баз: отпечаток адреса строки -> координаты, для повторных загрузок того же файла
+BASE_SNAPSHOT_PATH = os.environ.get('BASE_SNAPSHOT_PATH', './cache/snapshots.sqlite3')
+
+# Сжатие JSON, NDJSON и CSV ответов сервиса (gzip, br - если установлен пакет brotli)
+COMPRESS_MIN_SIZE = int(os.environ.get('COMPRESS_MIN_SIZE', 1024))  # Меньшие ответы не сжимаются, байт; потоковые сжимаются всегда
+COMPRESS_GZIP_LEVEL = int(os.environ.get('COMPRESS_GZIP_LEVEL', 6))
+COMPRESS_BROTLI_QUALITY = int(os.environ.get('COMPRESS_BROTLI_QUALITY', 5))  # 11 - максимум, но слишком медленно для ответов на лету
+
+# Метрики: каждый воркер периодически сбрасывает свои значения в общий SQLite
+METRICS_PATH = os.environ.get('METRICS_PATH', './cache/metrics.sqlite3')
+METRICS_FLUSH_INTERVAL = float(os.environ.get('METRICS_FLUSH_INTERVAL', 5))  # сек
+METRICS_STALE_AFTER = 300  # Снимки воркеров старше этого не учитываются, сек
+
+# Диагностика: разбивка времени запроса по стадиям и профилирование живого воркера
+ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN', '')  # Токен для /admin/* в заголовке X-Admin-Token; пустой - эндпоинты выключены
+PROFILE_MAX_SECONDS = float(os.environ.get('PROFILE_MAX_SECONDS', 60))  # Максимальная длительность профилирования, сек
+
+# Локальный пространственный индекс по уже найденным координатам
+SPATIAL_INDEX_SOURCES = os.environ.get('SPATIAL_INDEX_SOURCES', './uploads/*.xlsx')  # Шаблоны файлов через запятую
+SPATIAL_CELL = float(os.environ.get('SPATIAL_CELL', 0.25))  # Размер ячейки сетки, градусов
+SPATIAL_REVERSE_RADIUS = float(os.environ.get('SPATIAL_REVERSE_RADIUS', 0.5))  # Дальше этого точка не считается адресом, км
+SPATIAL_MAX_RESULTS = int(os.environ.get('SPATIAL_MAX_RESULTS', 1000))  # Максимум точек в ответе /spatial/nearest и /spatial/bbox
+EARTH_RADIUS_KM = 6371.0088
@@ -0,0 +1,19 @@
+"""Общие для воркеров файлы SQLite."""
+import os
+import sqlite3
+
+
+def open_sqlite(db_path):
+    """Соединение с общим для воркеров файлом SQLite.
+
+    WAL позволяет читать одновременно с записью, а synchronous=NORMAL убирает
+    fsync на каждую транзакцию: при падении процесса данные не теряются, при
+    отключении питания можно потерять последние записи кэша и счётчиков.
+    """
+    directory = os.path.dirname(db_path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    connection = sqlite3.connect(db_path, timeout=30, isolation_level=None, check_same_thread=False)
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.execute('PRAGMA synchronous=NORMAL')
+    return connection
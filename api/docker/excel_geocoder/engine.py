@@ -0,0 +1,291 @@
+"""Асинхронный движок геокодирования, общий для HTTP сервиса и командной строки."""
+import asyncio
+import logging
+import os
+
+import aiohttp
+
+from .addresses import clean_address, normalize_address
+from .config import (GEOCODER_CONCURRENCY, GEOCODER_HEDGE_AFTER, GEOCODER_KEEPALIVE, GEOCODER_KEYS_FILE,
+                     GEOCODER_POOL_SIZE, GEOCODER_PROVIDERS, GEOCODER_TIMEOUT)
+from .metrics import metrics
+from .providers import GazetteerProvider, NominatimProvider, ProviderUnavailable, QuotaExhausted, YandexProvider
+from .storage import GeocodeCache, KeyPool, RateLimiter
+from .timing import stage
+
+
+class AddressGeocoder:
+    # Общая сессия воркера: живёт всё время работы приложения и переиспользует
+    # keep-alive соединения, чтобы не платить за DNS, TCP и TLS на каждый адрес
+    session = None
+    # Общий кэш координат воркера, открывается в before_serving
+    cache = None
+    # Общий ограничитель частоты запросов, открывается в before_serving
+    limiter = None
+
+    def __init__(self, api_key_file, providers=None):
+        self.providers = []
+        for name in providers or GEOCODER_PROVIDERS:
+            if name == 'yandex':
+                self.providers.append(YandexProvider(KeyPool.shared(api_key_file or GEOCODER_KEYS_FILE), self.limiter))
+            elif name == 'nominatim':
+                self.providers.append(NominatimProvider())
+            elif name == 'gazetteer':
+                self.providers.append(GazetteerProvider())
+            else:
+                raise Exception(f"Неизвестный провайдер геокодирования: {name}")
+        if not self.providers:
+            raise Exception("Не задан ни один провайдер геокодирования.")
+        # Выставляется try_locate, когда квота всех ключей исчерпана
+        self.quota_exhausted = False
+
+    @classmethod
+    async def open_session(cls):
+        """Создание общей сессии с пулом keep-alive соединений."""
+        if cls.session is None or cls.session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=GEOCODER_POOL_SIZE,
+                keepalive_timeout=GEOCODER_KEEPALIVE,
+                ttl_dns_cache=300
+            )
+            cls.session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=GEOCODER_TIMEOUT)
+            )
+            logging.info(f"Сессия геокодера открыта (пул: {GEOCODER_POOL_SIZE} соединений).")
+        return cls.session
+
+    @classmethod
+    async def close_session(cls):
+        """Закрытие общей сессии при остановке приложения."""
+        if cls.session is not None and not cls.session.closed:
+            await cls.session.close()
+            logging.info("Сессия геокодера закрыта.")
+        cls.session = None
+
+    async def locate(self, address):
+        """(широта, долгота, точность) по адресу у настроенных провайдеров; (None, None, None), если не найден.
+
+        Если не ответил ни один провайдер, бросает ProviderUnavailable (QuotaExhausted,
+        если у всех исчерпана квота): адрес не найденным не считается и не кэшируется.
+        """
+        # Сначала смотрим в кэш, чтобы не тратить запросы из дневной квоты
+        if self.cache is not None:
+            with stage('cache'):
+                cached = self.cache.get(address)
+            if cached is not None:
+                return cached
+
+        # Сессия создаётся в before_serving; вне приложения открываем её по требованию
+        session = await self.open_session()
+        with stage('upstream'):
+            result = await self.query(session, address)
+        if result is None:
+            logging.warning(f"Координаты не найдены для адреса: {address}")
+            return None, None, None
+        if self.cache is not None:
+            self.cache.set(address, *result)
+        return result
+
+    async def try_locate(self, address):
+        """locate для обработки списков: None вместо отказа провайдеров, такой адрес не найденным не считается.
+
+        После исчерпания квоты ключей выставляется quota_exhausted, и дальше
+        адреса берутся только из кэша.
+        """
+        try:
+            if self.quota_exhausted:
+                return self.cache.get(address) if self.cache is not None else None
+            return await self.locate(address)
+        except QuotaExhausted:
+            if not self.quota_exhausted:
+                logging.warning("Дневная квота всех ключей исчерпана, остальные адреса - только из кэша.")
+            self.quota_exhausted = True
+        except ProviderUnavailable:
+            pass
+        return None
+
+    async def get_coordinates(self, address):
+        """Получение координат (широта, долгота) по адресу."""
+        latitude, longitude, _ = await self.locate(address)
+        return latitude, longitude
+
+    async def ask(self, provider, session, address):
+        """Один провайдер: координаты или None; отказ отмечается и пробрасывается в query."""
+        try:
+            result = await provider.geocode(session, address)
+        except ProviderUnavailable as e:
+            logging.error(f"Провайдер {provider.name} недоступен для адреса {address}: {str(e)}")
+            metrics.inc('geocoder_provider_results_total', provider=provider.name, result='unavailable')
+            provider.mark_down()
+            raise
+        metrics.inc('geocoder_provider_results_total', provider=provider.name, result='ok' if result else 'not_found')
+        return result
+
+    async def query(self, session, address):
+        """Опрос провайдеров по приоритету.
+
+        Если провайдер не ответил за GEOCODER_HEDGE_AFTER секунд, параллельно
+        спрашиваем следующего и берём первый найденный ответ. Если провайдер
+        отказал или не нашёл адрес, сразу переходим к следующему. Недавно
+        отказавшие провайдеры опрашиваются последними. Если отказали все,
+        бросает отказ одного из них, QuotaExhausted - только если у всех квота.
+        """
+        queue = iter(sorted(self.providers, key=lambda provider: not provider.available()))
+        pending = {}
+
+        def launch():
+            provider = next(queue, None)
+            if provider is None:
+                return False
+            pending[asyncio.ensure_future(self.ask(provider, session, address))] = provider
+            return True
+
+        launch()
+        exhausted = len(self.providers) == 1
+        failures = []
+        try:
+            while pending:
+                hedge = GEOCODER_HEDGE_AFTER if GEOCODER_HEDGE_AFTER > 0 and not exhausted else None
+                done, _ = await asyncio.wait(pending, timeout=hedge, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    if launch():
+                        metrics.inc('geocoder_hedged_total')
+                    else:
+                        exhausted = True
+                    continue
+                for task in done:
+                    pending.pop(task)
+                    try:
+                        result = task.result()
+                    except ProviderUnavailable as e:
+                        failures.append(e)
+                    else:
+                        if result is not None:
+                            return result
+                    if not launch():
+                        exhausted = True
+        finally:
+            for task in pending:
+                task.cancel()
+        # Ни один провайдер не ответил - это не «не найден», адрес нужно запросить позже
+        if len(failures) == len(self.providers):
+            raise next((e for e in failures if not isinstance(e, QuotaExhausted)), failures[0])
+        return None
+
+    async def get_coordinates_many(self, addresses, concurrency=GEOCODER_CONCURRENCY, callback=None):
+        """Параллельное получение (широта, долгота, точность) для списка адресов.
+
+        Одновременно выполняется не больше concurrency запросов, результаты
+        возвращаются в том же порядке, что и адреса. callback(позиция, результат)
+        вызывается сразу по готовности каждого адреса.
+
+        Адрес, по которому не ответил ни один провайдер, получает None вместо
+        результата (см. try_locate).
+        """
+        semaphore = asyncio.Semaphore(max(1, concurrency))
+
+        async def bounded(position, address):
+            async with semaphore:
+                result = await self.try_locate(address)
+            if callback is not None:
+                callback(position, result)
+            return result
+
+        # При ошибке оставшиеся адреса отменяются: иначе они доработали бы в фоне и
+        # их колбэки писали бы результаты уже после выхода вызывающего
+        tasks = [asyncio.ensure_future(bounded(position, address)) for position, address in enumerate(addresses)]
+        try:
+            return await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+
+
+async def geocode_stream(addresses, geocoder, concurrency=GEOCODER_CONCURRENCY):
+    """Геокодирование потока адресов с выдачей результатов по мере готовности.
+
+    addresses - асинхронный итератор адресов; обработка начинается, не
+    дожидаясь конца входа. Одинаковые после нормализации адреса запрашиваются
+    один раз. Выдаёт словари index/address/latitude/longitude/precision/status в порядке
+    готовности, а не входа; status unavailable - не ответил ни один провайдер.
+    """
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+    results = asyncio.Queue()
+    lookups = {}  # Нормализованный адрес -> задача запроса
+    tasks = []
+
+    async def lookup(address):
+        async with semaphore:
+            return await geocoder.locate(clean_address(address))
+
+    async def resolve(index, address, task):
+        try:
+            latitude, longitude, precision = await task
+        except ProviderUnavailable:
+            latitude = longitude = precision = None
+            status = 'unavailable'
+        else:
+            status = 'ok' if latitude is not None and longitude is not None else 'not_found'
+        await results.put({'index': index, 'address': address, 'latitude': latitude, 'longitude': longitude,
+                           'precision': precision, 'status': status})
+
+    async def feed():
+        try:
+            index = 0
+            async for address in addresses:
+                if not isinstance(address, str) or not clean_address(address):
+                    await results.put({'index': index, 'address': address, 'latitude': None, 'longitude': None, 'precision': None, 'status': 'empty'})
+                else:
+                    key = normalize_address(address)
+                    if key not in lookups:
+                        lookups[key] = asyncio.ensure_future(lookup(address))
+                    tasks.append(asyncio.ensure_future(resolve(index, address, lookups[key])))
+                index += 1
+            await asyncio.gather(*tasks)
+        finally:
+            # При ошибке разбора входа уже начатые адреса дорабатываются и доходят до клиента
+            await asyncio.gather(*tasks, return_exceptions=True)
+            await results.put(None)  # Конец потока
+
+    feeder = asyncio.ensure_future(feed())
+    try:
+        while True:
+            item = await results.get()
+            if item is None:
+                break
+            yield item
+        await feeder  # Пробрасываем ошибку разбора входа, если она была
+    finally:
+        for task in [feeder, *tasks, *lookups.values()]:
+            task.cancel()
+
+
+async def open_geocoder():
+    """Открытие общих ресурсов геокодера: сессии, кэша, ограничителя частоты,
+    пула ключей и справочника адресов.
+
+    Вызывается один раз на процесс - в before_serving сервиса или в начале
+    запуска из командной строки, - поэтому настройки пулов и кэшей одинаковы везде.
+    """
+    await AddressGeocoder.open_session()
+    if AddressGeocoder.cache is None:
+        AddressGeocoder.cache = GeocodeCache()
+    if AddressGeocoder.limiter is None:
+        AddressGeocoder.limiter = RateLimiter()
+    if 'yandex' in GEOCODER_PROVIDERS and os.path.exists(GEOCODER_KEYS_FILE):
+        KeyPool.shared(GEOCODER_KEYS_FILE)
+    if 'gazetteer' in GEOCODER_PROVIDERS:
+        GazetteerProvider.load()
+
+
+async def close_geocoder():
+    """Закрытие ресурсов, открытых open_geocoder."""
+    await AddressGeocoder.close_session()
+    if AddressGeocoder.cache is not None:
+        AddressGeocoder.cache.close()
+        AddressGeocoder.cache = None
+    if AddressGeocoder.limiter is not None:
+        AddressGeocoder.limiter.close()
+        AddressGeocoder.limiter = None
+    KeyPool.close_shared()
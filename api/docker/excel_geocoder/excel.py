@@ -0,0 +1,818 @@
+"""Чтение и запись книг Excel и геокодирование их строк.
+
+Единственный, вместе с spatial, модуль пакета, которому нужны pandas, NumPy
+и openpyxl: они загружаются только при первом обращении к нему.
+"""
+import asyncio
+import functools
+import itertools
+import logging
+import os
+import uuid
+
+import numpy as np
+import openpyxl
+import pandas as pd
+
+from . import executor
+from .addresses import address_fingerprint, group_addresses
+from .config import (CHECKPOINT_BATCH, EXCEL_LEGACY_COORDINATES, EXCEL_STREAM_CHUNK, EXCEL_STREAM_THRESHOLD,
+                     FRAME_CACHE_DIR, GEOCODER_CONCURRENCY, MAX_REQUESTS)
+from .files import file_fingerprint, file_state, record_write
+from .metrics import metrics
+from .storage import BaseSnapshots, CheckpointStore
+from .timing import stage
+
+
+def parse_coordinates(values):
+    """Разбор строк "широта, долгота" в два массива float64; нераспознанные значения - NaN."""
+    parts = pd.Series(values, dtype=object).astype(str).str.split(',', n=1, expand=True)
+    if parts.shape[1] < 2:
+        nan = np.full(len(parts), np.nan)
+        return nan, nan.copy()
+    latitudes = pd.to_numeric(parts[0].str.strip(), errors='coerce').to_numpy(dtype='float64')
+    longitudes = pd.to_numeric(parts[1].str.strip(), errors='coerce').to_numpy(dtype='float64')
+    return latitudes, longitudes
+
+
+class ExcelHandler:
+    def __init__(self, file_path, file_hash=None):
+        self.file_path = file_path
+        # Хэш загрузки: ключ колоночной копии; без него работаем только с xlsx
+        self.file_hash = file_hash
+        self.dataframe = None
+        # Состояние xlsx (files.file_state), из которого получены данные dataframe
+        self.source_state = None
+
+    # Колонки результата: числовые координаты, статус и точность ответа геокодера
+    LATITUDE_COLUMN = 'Широта'
+    LONGITUDE_COLUMN = 'Долгота'
+    STATUS_COLUMN = 'Статус'
+    PRECISION_COLUMN = 'Точность'
+
+    # Форматы копии по убыванию предпочтения: Feather, а для колонок со
+    # смешанными типами, которые Arrow не принимает, - pickle
+    FRAME_FORMATS = {'.feather': (pd.read_feather, 'to_feather'), '.pkl': (pd.read_pickle, 'to_pickle')}
+
+    def frame_path(self, extension='.feather'):
+        """Путь к копии книги в заданном формате или None без хэша."""
+        if self.file_hash is None:
+            return None
+        return os.path.join(FRAME_CACHE_DIR, f"{self.file_hash}{extension}")
+
+    def existing_frame(self):
+        """Путь к уже сохранённой копии книги или None.
+
+        Копия годится, только если xlsx не меняли в обход неё: рядом с копией
+        записано состояние xlsx, из которого она получена, и оно сверяется с
+        текущим.
+        """
+        for extension in self.FRAME_FORMATS:
+            path = self.frame_path(extension)
+            if path is not None and os.path.exists(path):
+                if self.frame_source() == file_state(self.file_path):
+                    return path
+                logging.info(f"Колоночная копия {path} не соответствует {self.file_path} и не используется")
+                return None
+        return None
+
+    def frame_source(self):
+        """Состояние xlsx, записанное вместе с копией.
+
+        У копий, сохранённых до появления этой записи, её нет: такая копия
+        считается соответствующей xlsx, если он не новее её.
+        """
+        try:
+            with open(self.frame_path('.source'), 'r') as f:
+                return f.read().strip()
+        except FileNotFoundError:
+            frame_path = next(path for path in map(self.frame_path, self.FRAME_FORMATS) if os.path.exists(path))
+            if os.path.getmtime(frame_path) >= os.path.getmtime(self.file_path):
+                return file_state(self.file_path)
+            return None
+
+    def record_frame_source(self, state):
+        """Запись состояния xlsx, которому соответствует копия."""
+        source_path = self.frame_path('.source')
+        temp_path = f"{source_path}.{uuid.uuid4().hex}.tmp"
+        with open(temp_path, 'w') as f:
+            f.write(state)
+        os.replace(temp_path, source_path)
+
+    async def run_in_executor(self, function, *args):
+        """Выполнение блокирующей функции в пуле Excel."""
+        return await executor.run_in_executor(function, *args)
+
+    async def read_excel(self):
+        """Асинхронное чтение Excel файла и сохранение данных в dataframe.
+
+        Если для файла уже есть колоночная копия, читается она: это на порядки
+        быстрее разбора xlsx через openpyxl.
+        """
+        try:
+            frame_path = self.existing_frame()
+            if frame_path is not None:
+                extension = os.path.splitext(frame_path)[1]
+                reader, _ = self.FRAME_FORMATS[extension]
+                with metrics.timer('excel_io_seconds', operation='read', format=extension.lstrip('.')):
+                    self.dataframe = await self.run_in_executor(reader, frame_path)
+                self.source_state = self.frame_source()
+                logging.info(f"Данные прочитаны из колоночной копии: {frame_path}")
+                return
+            self.source_state = file_state(self.file_path)
+            with metrics.timer('excel_io_seconds', operation='read', format='xlsx'):
+                self.dataframe = await self.run_in_executor(pd.read_excel, self.file_path)
+            logging.info("Excel файл успешно прочитан.")
+        except FileNotFoundError:
+            raise Exception(f"Файл {self.file_path} не найден.")
+        except Exception as e:
+            raise Exception(f"Ошибка при чтении файла: {str(e)}")
+    
+    def add_coordinates_column(self, coordinates_column_name='Координаты'):
+        """Добавление колонок результата, которых ещё нет, и приведение их типов.
+
+        Широта и Долгота всегда float64, Статус и Точность - строки. Строковая
+        колонка coordinates_column_name добавляется, если включена
+        EXCEL_LEGACY_COORDINATES. Возвращает число добавленных колонок.
+        """
+        if self.dataframe is None:
+            raise Exception("Dataframe не загружен. Сначала вызовите метод read_excel.")
+        columns = [self.LATITUDE_COLUMN, self.LONGITUDE_COLUMN, self.STATUS_COLUMN, self.PRECISION_COLUMN]
+        if EXCEL_LEGACY_COORDINATES:
+            columns.append(coordinates_column_name)
+        added = 0
+        for column in columns:
+            if column not in self.dataframe.columns:
+                self.dataframe[column] = None
+                added += 1
+                logging.info(f"Колонка '{column}' добавлена.")
+        for column in (self.LATITUDE_COLUMN, self.LONGITUDE_COLUMN):
+            self.dataframe[column] = pd.to_numeric(self.dataframe[column], errors='coerce').astype('float64')
+        for column in (self.STATUS_COLUMN, self.PRECISION_COLUMN):
+            self.dataframe[column] = self.dataframe[column].astype(object)
+        return added
+
+    def migrate_coordinates(self, coordinates_column_name='Координаты'):
+        """Перенос строк "широта, долгота" в Широта/Долгота там, где они ещё пусты.
+
+        Разбор векторный, по всей колонке сразу. Возвращает число перенесённых строк.
+        """
+        if coordinates_column_name not in self.dataframe.columns:
+            return 0
+        mask = self.dataframe[self.LATITUDE_COLUMN].isna() & self.dataframe[coordinates_column_name].notna()
+        if not mask.any():
+            return 0
+        latitudes, longitudes = parse_coordinates(self.dataframe.loc[mask, coordinates_column_name])
+        parsed = ~np.isnan(latitudes) & ~np.isnan(longitudes)
+        rows = self.dataframe.index[mask][parsed]
+        self.dataframe.loc[rows, self.LATITUDE_COLUMN] = latitudes[parsed]
+        self.dataframe.loc[rows, self.LONGITUDE_COLUMN] = longitudes[parsed]
+        self.dataframe.loc[rows, self.STATUS_COLUMN] = 'ok'
+        if len(rows):
+            logging.info(f"Перенесено координат из колонки '{coordinates_column_name}': {len(rows)}")
+        return len(rows)
+
+    def pending_addresses(self, address_column_name='Адрес', start_row=0):
+        """Пары (индекс, адрес) строк, где адрес есть, а координат ещё нет.
+
+        Выбор делается одной векторной маской по двум колонкам, без обхода строк;
+        строки до start_row пропускаются.
+        """
+        if self.dataframe is None:
+            raise Exception("Dataframe не загружен. Сначала вызовите метод read_excel.")
+        if address_column_name not in self.dataframe.columns:
+            logging.warning(f"Колонка '{address_column_name}' не найдена.")
+            return []
+        mask = self.dataframe[address_column_name].notna() & self.dataframe[self.LATITUDE_COLUMN].isna()
+        if start_row:
+            mask &= self.dataframe.index >= start_row
+        addresses = self.dataframe.loc[mask, address_column_name]
+        return list(zip(addresses.index, addresses))
+
+    def set_coordinates(self, results, coordinates_column_name='Координаты'):
+        """Запись результатов по колонкам одним присваиванием на колонку.
+
+        results - словарь индекс -> (широта, долгота, точность); строки без
+        координат получают статус not_found.
+        """
+        found = {index: result for index, result in results.items() if result[0] is not None and result[1] is not None}
+        if found:
+            rows = list(found)
+            latitudes, longitudes, precisions = zip(*found.values())
+            self.dataframe.loc[rows, self.LATITUDE_COLUMN] = latitudes
+            self.dataframe.loc[rows, self.LONGITUDE_COLUMN] = longitudes
+            self.dataframe.loc[rows, self.PRECISION_COLUMN] = precisions
+            self.dataframe.loc[rows, self.STATUS_COLUMN] = 'ok'
+            if coordinates_column_name in self.dataframe.columns:
+                self.dataframe.loc[rows, coordinates_column_name] = [
+                    f"{latitude}, {longitude}" for latitude, longitude in zip(latitudes, longitudes)
+                ]
+        missing = [index for index in results if index not in found]
+        if missing:
+            self.dataframe.loc[missing, self.STATUS_COLUMN] = 'not_found'
+
+    def row_fingerprints(self, address_column_name='Адрес'):
+        """Отпечатки адресов строк (Series по индексу таблицы); у строк без адреса - NaN."""
+        return self.dataframe[address_column_name].map(address_fingerprint, na_action='ignore')
+
+    def apply_snapshot(self, fingerprints, snapshot, coordinates_column_name='Координаты'):
+        """Сравнение строк с прошлой версией базы.
+
+        Строки без координат, чей адрес был в прошлой версии, получают
+        координаты из неё. Если координаты строки есть в прошлой версии, но у
+        другого адреса, адрес строки изменили: координаты заменяются
+        координатами её нового адреса из прошлой версии, а если его там нет -
+        сбрасываются, чтобы найти их заново. Координаты неизвестного
+        происхождения не трогаются. Возвращает число строк с перенесёнными и
+        с заменёнными или сброшенными координатами.
+        """
+        known = fingerprints.isin(list(snapshot))
+        located = self.dataframe[self.LATITUDE_COLUMN].notna()
+        copied = fingerprints.index[known & ~located]
+        if len(copied):
+            self.set_coordinates({index: snapshot[fingerprints[index]] for index in copied}, coordinates_column_name)
+        points = pd.MultiIndex.from_arrays([self.dataframe[self.LATITUDE_COLUMN], self.dataframe[self.LONGITUDE_COLUMN]])
+        from_snapshot = points.isin([(latitude, longitude) for latitude, longitude, _ in snapshot.values()])
+        # Адрес заменён другим адресом из прошлой версии: координаты строки не те, что у него там
+        candidates = fingerprints.index[known & located & from_snapshot]
+        expected = [snapshot[fingerprint] for fingerprint in fingerprints[candidates]]
+        moved = candidates[
+            (self.dataframe.loc[candidates, self.LATITUDE_COLUMN].to_numpy() != np.array([value[0] for value in expected], dtype=float))
+            | (self.dataframe.loc[candidates, self.LONGITUDE_COLUMN].to_numpy() != np.array([value[1] for value in expected], dtype=float))
+        ]
+        if len(moved):
+            self.set_coordinates({index: snapshot[fingerprints[index]] for index in moved}, coordinates_column_name)
+        changed = fingerprints.index[fingerprints.notna() & ~known & located & from_snapshot]
+        if len(changed):
+            self.dataframe.loc[changed, [self.LATITUDE_COLUMN, self.LONGITUDE_COLUMN]] = np.nan
+            columns = [self.STATUS_COLUMN, self.PRECISION_COLUMN]
+            if coordinates_column_name in self.dataframe.columns:
+                columns.append(coordinates_column_name)
+            self.dataframe.loc[changed, columns] = None
+        return len(copied), len(moved) + len(changed)
+
+    def snapshot(self, fingerprints):
+        """Снимок версии: отпечаток -> (широта, долгота, точность) для строк с координатами."""
+        mask = fingerprints.notna() & self.dataframe[self.LATITUDE_COLUMN].notna()
+        rows = self.dataframe.loc[mask]
+        precisions = rows[self.PRECISION_COLUMN].astype(object).where(rows[self.PRECISION_COLUMN].notna(), None)
+        return dict(zip(fingerprints[mask], zip(rows[self.LATITUDE_COLUMN].tolist(), rows[self.LONGITUDE_COLUMN].tolist(),
+                                                precisions.tolist())))
+    
+    async def save(self):
+        """Сохранение изменений в колоночную копию; xlsx пишется только при скачивании.
+
+        Без хэша файла или если копию не удалось записать ни в одном формате,
+        изменения сразу сохраняются в Excel.
+        """
+        if self.file_hash is not None:
+            os.makedirs(FRAME_CACHE_DIR, exist_ok=True)
+            for extension, (_, writer) in self.FRAME_FORMATS.items():
+                frame_path = self.frame_path(extension)
+                temp_path = f"{frame_path}.{uuid.uuid4().hex}.tmp"
+                try:
+                    with metrics.timer('excel_io_seconds', operation='write', format=extension.lstrip('.')):
+                        await self.run_in_executor(functools.partial(getattr(self.dataframe, writer), temp_path))
+                    os.replace(temp_path, frame_path)
+                    self.record_frame_source(self.source_state or file_state(self.file_path))
+                except Exception as e:
+                    logging.warning(f"Не удалось сохранить копию в формате {extension}: {str(e)}")
+                    if os.path.exists(temp_path):
+                        os.remove(temp_path)
+                    continue
+                # Копия в другом формате теперь устарела
+                for other in self.FRAME_FORMATS:
+                    if other != extension and os.path.exists(self.frame_path(other)):
+                        os.remove(self.frame_path(other))
+                logging.info(f"Колоночная копия сохранена: {frame_path}")
+                return
+            # Прежняя копия, если она есть, отстала бы от xlsx
+            self.drop_frames()
+        await self.save_excel()
+
+    def drop_frames(self):
+        """Удаление колоночных копий, когда xlsx изменён в обход них."""
+        for extension in (*self.FRAME_FORMATS, '.source'):
+            path = self.frame_path(extension)
+            if path is not None and os.path.exists(path):
+                os.remove(path)
+
+    def excel_is_stale(self):
+        """True, если колоночная копия новее xlsx и файл нужно перевыпустить."""
+        frame_path = self.existing_frame()
+        return frame_path is not None and os.path.getmtime(frame_path) > os.path.getmtime(self.file_path)
+
+    async def export_excel(self):
+        """Запись xlsx из колоночной копии перед отдачей файла клиенту."""
+        if not self.excel_is_stale():
+            return
+        if self.dataframe is None:
+            await self.read_excel()
+        await self.save_excel()
+
+    async def save_excel(self):
+        """Асинхронное сохранение Excel файла с изменениями."""
+        try:
+            with metrics.timer('excel_io_seconds', operation='write', format='xlsx'):
+                await self.run_in_executor(functools.partial(self.dataframe.to_excel, self.file_path, index=False))
+            record_write(self.file_path)
+            # xlsx теперь совпадает с копией
+            if self.file_hash is not None and any(os.path.exists(self.frame_path(extension)) for extension in self.FRAME_FORMATS):
+                self.record_frame_source(file_state(self.file_path))
+            logging.info(f"Файл успешно сохранен: {self.file_path}")
+        except Exception as e:
+            raise Exception(f"Ошибка при сохранении Excel файла: {str(e)}")
+
+
+class StreamingWorkbook:
+    """Построчное чтение и запись xlsx через openpyxl без DataFrame в памяти.
+
+    Первый лист читается в режиме read_only, результат пишется в write_only
+    книгу во временный файл, который заменяет исходный в commit(). Меняются
+    только колонки результата - Широта, Долгота, Статус, Точность и строковая
+    колонка координат, если она есть, - остальные ячейки переносятся значениями.
+    Методы блокирующие и вызываются через asyncio.to_thread: открытые книги
+    нельзя передать в пул процессов. modified - было ли что менять: если
+    нет, исходный файл можно не перезаписывать.
+    """
+
+    def __init__(self, file_path, address_column_name='Адрес', coordinates_column_name='Координаты'):
+        self.file_path = file_path
+        self.coordinates_column_name = coordinates_column_name
+        self.temp_path = f"{file_path}.{uuid.uuid4().hex}.tmp"
+        self.source = openpyxl.load_workbook(file_path, read_only=True, data_only=True)
+        sheet = self.source.worksheets[0]
+        self.total_rows = max(0, (sheet.max_row or 1) - 1)
+        self.rows = sheet.iter_rows(values_only=True)
+        self.modified = False
+
+        header = list(next(self.rows, ()))
+        self.address_column = header.index(address_column_name) if address_column_name in header else None
+        columns = [ExcelHandler.LATITUDE_COLUMN, ExcelHandler.LONGITUDE_COLUMN,
+                   ExcelHandler.STATUS_COLUMN, ExcelHandler.PRECISION_COLUMN]
+        if EXCEL_LEGACY_COORDINATES:
+            columns.append(coordinates_column_name)
+        for column in columns:
+            if column not in header:
+                header.append(column)
+                self.modified = True
+                logging.info(f"Колонка '{column}' добавлена.")
+        # Позиции колонок результата; строковой может не быть, если она отключена
+        self.columns = {column: header.index(column) for column in header if column in columns + [coordinates_column_name]}
+        self.width = len(header)
+
+        self.target = openpyxl.Workbook(write_only=True)
+        self.output = self.target.create_sheet(sheet.title)
+        self.output.append(header)
+
+    def read_chunk(self, size):
+        """Следующие size строк списками значений, дополненными до ширины заголовка.
+
+        Строки, где есть только старая строковая колонка, сразу получают
+        Широту и Долготу из неё.
+        """
+        chunk = [list(row) + [None] * (self.width - len(row)) for row in itertools.islice(self.rows, size)]
+        legacy = self.columns.get(self.coordinates_column_name)
+        latitude, longitude = self.columns[ExcelHandler.LATITUDE_COLUMN], self.columns[ExcelHandler.LONGITUDE_COLUMN]
+        if legacy is not None:
+            rows = [row for row in chunk if row[latitude] is None and row[legacy] is not None]
+            if rows:
+                latitudes, longitudes = parse_coordinates([row[legacy] for row in rows])
+                for row, lat, lon in zip(rows, latitudes, longitudes):
+                    if not (np.isnan(lat) or np.isnan(lon)):
+                        row[latitude], row[longitude] = float(lat), float(lon)
+                        row[self.columns[ExcelHandler.STATUS_COLUMN]] = 'ok'
+                        self.modified = True
+        return chunk
+
+    def set_result(self, row, result):
+        """Запись (широта, долгота, точность) в строку; без координат - статус not_found."""
+        latitude, longitude, precision = result
+        self.modified = True
+        if latitude is None or longitude is None:
+            row[self.columns[ExcelHandler.STATUS_COLUMN]] = 'not_found'
+            return
+        row[self.columns[ExcelHandler.LATITUDE_COLUMN]] = latitude
+        row[self.columns[ExcelHandler.LONGITUDE_COLUMN]] = longitude
+        row[self.columns[ExcelHandler.PRECISION_COLUMN]] = precision
+        row[self.columns[ExcelHandler.STATUS_COLUMN]] = 'ok'
+        if self.coordinates_column_name in self.columns:
+            row[self.columns[self.coordinates_column_name]] = f"{latitude}, {longitude}"
+
+    def clear_result(self, row):
+        """Сброс координат строки, чтобы найти их заново."""
+        self.modified = True
+        for column in self.columns.values():
+            row[column] = None
+
+    def result(self, row):
+        """(широта, долгота, точность) строки или None, если координат нет."""
+        latitude = row[self.columns[ExcelHandler.LATITUDE_COLUMN]]
+        longitude = row[self.columns[ExcelHandler.LONGITUDE_COLUMN]]
+        if latitude is None or longitude is None:
+            return None
+        return latitude, longitude, row[self.columns[ExcelHandler.PRECISION_COLUMN]]
+
+    def write_rows(self, rows):
+        for row in rows:
+            self.output.append(row)
+
+    def commit(self):
+        """Запись результата и атомарная замена исходного файла."""
+        self.source.close()
+        self.target.save(self.temp_path)
+        os.replace(self.temp_path, self.file_path)
+        record_write(self.file_path)
+
+    def abort(self):
+        self.source.close()
+        # Выходной лист пишется во временный файл openpyxl: он закрывается и удаляется
+        # сразу, а не при сборке мусора или выходе из процесса
+        try:
+            self.output.close()
+            self.output._writer.cleanup()
+        except Exception as e:
+            logging.debug(f"Выходной лист уже закрыт: {str(e)}")
+        if os.path.exists(self.temp_path):
+            os.remove(self.temp_path)
+
+
+async def geocode_file_streaming(file_path, geocoder, concurrency=GEOCODER_CONCURRENCY, max_requests=MAX_REQUESTS,
+                                 progress=None, resume=True, on_row=None, base=None, diff=True):
+    """Геокодирование большой книги кусками по EXCEL_STREAM_CHUNK строк.
+
+    В памяти держится один кусок: он читается, его адреса геокодируются,
+    и строки сразу дописываются в выходную книгу. Контрольные точки, resume
+    и колбэки работают так же, как в geocode_file, результаты сбрасываются
+    пачками по CHECKPOINT_BATCH по мере готовности; progress получает число
+    просмотренных строк из общего числа строк листа. Сохранённые результаты
+    и снимок прошлой версии базы читаются из SQLite по кускам, снимок этой
+    версии туда же по кускам пишется, поэтому память не растёт с размером листа.
+    """
+    checkpoints = CheckpointStore.open()
+    file_hash = await file_fingerprint(file_path)
+    # Колоночная копия новее xlsx сначала переносится в него: после потоковой записи она удаляется
+    with stage('export'):
+        await ExcelHandler(file_path, file_hash).export_excel()
+    with stage('checkpoint'):
+        start_row = checkpoints.next_row(file_hash) if resume else 0
+
+    with metrics.timer('excel_io_seconds', operation='read', format='xlsx-stream'), stage('read'):
+        workbook = await asyncio.to_thread(StreamingWorkbook, file_path)
+    if workbook.address_column is None:
+        workbook.abort()
+        logging.warning("Колонка 'Адрес' не найдена.")
+        return {'requests': 0, 'rows': 0, 'errors': 0, 'copied': 0, 'changed': 0, 'unavailable': 0}
+    address_column = workbook.address_column
+    latitude_column = workbook.columns[ExcelHandler.LATITUDE_COLUMN]
+    longitude_column = workbook.columns[ExcelHandler.LONGITUDE_COLUMN]
+
+    snapshots = BaseSnapshots.open()
+    base = base or BaseSnapshots.default_base(file_path)
+    previous = diff and snapshots.version(base) is not None
+    draft = snapshots.stage() if diff else None  # Снимок этой версии, дописывается по кускам
+    copied = changed = 0
+
+    requests_left = max_requests
+    request_count = row_count = errors = unavailable = 0
+    next_row = None  # Первая строка, до которой не дошла очередь из-за лимита запросов или отказа провайдеров
+    index = 0
+    # Текущий кусок: группы адресов, (строка, позиция группы) в порядке листа и готовые группы
+    chunk, groups, row_groups = [], [], []
+    finished = set()
+    batch = {}
+    cursor = 0
+
+    def flush(end):
+        """Сброс пачки; продолжение - с первой строки, группа которой ещё не готова, или с end."""
+        nonlocal cursor
+        while cursor < len(row_groups) and row_groups[cursor][1] in finished:
+            cursor += 1
+        position = row_groups[cursor][0] if cursor < len(row_groups) else end
+        with stage('checkpoint'):
+            checkpoints.save(file_hash, batch, position if next_row is None else min(position, next_row))
+        batch.clear()
+
+    def on_result(position, result):
+        nonlocal errors
+        # Не ответил ни один провайдер: группа не готова, курсор останавливается перед ней
+        if result is None:
+            return
+        finished.add(position)
+        latitude, longitude, precision = result
+        for row_index in groups[position][1]:
+            row = chunk[row_index - index]
+            workbook.set_result(row, result)
+            if latitude is None or longitude is None:
+                errors += 1
+            else:
+                batch[row_index] = result
+            if on_row is not None:
+                on_row(row_index, row[address_column], latitude, longitude, precision)
+        if len(batch) >= CHECKPOINT_BATCH:
+            flush(index + len(chunk))
+
+    try:
+        while True:
+            with stage('read'):
+                chunk = await asyncio.to_thread(workbook.read_chunk, EXCEL_STREAM_CHUNK)
+            if not chunk:
+                break
+            end = index + len(chunk)
+
+            # Восстановление результатов прошлого запуска, не попавших в файл
+            with stage('checkpoint'):
+                saved = checkpoints.load_rows(file_hash, index, end)
+            for offset, row in enumerate(chunk):
+                if row[latitude_column] is None and index + offset in saved:
+                    workbook.set_result(row, saved[index + offset])
+
+            # Сравнение с прошлой версией базы (см. ExcelHandler.apply_snapshot): адрес тот же -
+            # координаты оттуда; изменён (координаты строки там есть, но у другого адреса) -
+            # координаты нового адреса оттуда же, а если его там нет - ищем заново
+            with stage('diff'):
+                fingerprints = [address_fingerprint(row[address_column]) if diff and row[address_column] is not None else None
+                                for row in chunk]
+                known = snapshots.lookup(base, {fingerprint for fingerprint in fingerprints if fingerprint is not None}) if previous else {}
+                # Строки, чьи координаты не совпадают с координатами их адреса в прошлой версии
+                stale = [
+                    previous and fingerprint is not None and row[latitude_column] is not None
+                    and (fingerprint not in known or (row[latitude_column], row[longitude_column]) != known[fingerprint][:2])
+                    for row, fingerprint in zip(chunk, fingerprints)
+                ]
+                points = snapshots.known_points(base, [
+                    (row[latitude_column], row[longitude_column]) for row, moved in zip(chunk, stale) if moved
+                ]) if previous else set()
+                for row, fingerprint, moved in zip(chunk, fingerprints, stale):
+                    if fingerprint is None or not previous:
+                        continue
+                    if row[latitude_column] is None and fingerprint in known:
+                        workbook.set_result(row, known[fingerprint])
+                        copied += 1
+                    elif moved and (row[latitude_column], row[longitude_column]) in points:
+                        if fingerprint in known:
+                            workbook.set_result(row, known[fingerprint])
+                        else:
+                            workbook.clear_result(row)
+                        changed += 1
+
+            with stage('select'):
+                pending = [(index + offset, row[address_column]) for offset, row in enumerate(chunk)
+                           if index + offset >= start_row and row[address_column] is not None and row[latitude_column] is None]
+                groups = group_addresses(pending, limit=requests_left) if requests_left > 0 else []
+            grouped = sum(len(indices) for _, indices in groups)
+            if grouped < len(pending) and next_row is None:
+                next_row = pending[grouped][0]
+                if not geocoder.quota_exhausted:
+                    logging.info(f"Достигнуто максимальное количество запросов ({max_requests}). Сохранение файла.")
+            position_by_index = {}
+            for position, (_, indices) in enumerate(groups):
+                position_by_index.update(dict.fromkeys(indices, position))
+            row_groups = [(row_index, position_by_index[row_index]) for row_index, _ in pending[:grouped]]
+            finished.clear()
+            cursor = 0
+
+            with stage('geocode'):
+                results = await geocoder.get_coordinates_many([address for address, _ in groups], concurrency,
+                                                              on_result) if groups else []
+            answered = answered_rows = 0
+            for (_, indices), result in zip(groups, results):
+                # Не ответил ни один провайдер: строки остаются без статуса, и
+                # продолжение начнётся не дальше первой из них
+                if result is None:
+                    unavailable += len(indices)
+                    next_row = min(indices if next_row is None else [next_row, *indices])
+                else:
+                    answered += 1
+                    answered_rows += len(indices)
+
+            # Квота ключей исчерпана: дальше строки только читаются и пишутся
+            requests_left = 0 if geocoder.quota_exhausted else requests_left - answered
+            request_count += answered
+            row_count += answered_rows
+            metrics.inc('rows_processed_total', answered_rows)
+            if draft is not None:
+                current = {}
+                for row, fingerprint in zip(chunk, fingerprints):
+                    result = workbook.result(row) if fingerprint is not None else None
+                    if result is not None:
+                        current[fingerprint] = result
+                with stage('diff'):
+                    snapshots.add(draft, current)
+            flush(end)
+            index = end
+            with stage('write'):
+                await asyncio.to_thread(workbook.write_rows, chunk)
+            if progress is not None:
+                progress(index, max(index, workbook.total_rows), errors)
+
+        # Книга, в которой ничего не поменялось, не перезаписывается: она сохраняет
+        # время изменения и ETag, и повторный опрос получает 304
+        if workbook.modified:
+            with metrics.timer('excel_io_seconds', operation='write', format='xlsx-stream'), stage('write'):
+                await asyncio.to_thread(workbook.commit)
+        else:
+            workbook.abort()
+    except BaseException:
+        workbook.abort()
+        if draft is not None:
+            snapshots.discard(draft)
+        raise
+
+    # xlsx изменён напрямую: колоночная копия устарела, контрольная точка больше не нужна.
+    # Если с позиции продолжения делать было нечего, следующий запуск начнёт с начала
+    if workbook.modified:
+        ExcelHandler(file_path, file_hash).drop_frames()
+    checkpoints.clear_rows(file_hash)
+    if next_row is None and not row_count and start_row:
+        checkpoints.save(file_hash, {}, 0)
+    if draft is not None:
+        with stage('diff'):
+            snapshots.commit(draft, base, file_hash)
+    if copied or changed:
+        logging.info(f"Сравнение с прошлой версией '{base}': перенесено координат {copied}, изменённых адресов {changed}")
+    if unavailable:
+        logging.warning(f"Провайдеры не ответили, строк отложено до следующего запуска: {unavailable}")
+    logging.info(f"Потоковая обработка завершена. Обработано запросов: {request_count}, строк: {row_count}")
+    return {'requests': request_count, 'rows': row_count, 'errors': errors, 'copied': copied, 'changed': changed,
+            'unavailable': unavailable}
+
+
+def use_streaming(file_path, file_hash, streaming=None):
+    """Нужна ли потоковая обработка: явно запрошена или книга больше EXCEL_STREAM_THRESHOLD.
+
+    Если уже есть колоночная копия, она новее xlsx и быстрее, поэтому
+    автоматически потоковый режим тогда не выбирается.
+    """
+    if streaming is not None:
+        return bool(streaming)
+    if EXCEL_STREAM_THRESHOLD <= 0 or os.path.getsize(file_path) < EXCEL_STREAM_THRESHOLD:
+        return False
+    return ExcelHandler(file_path, file_hash).existing_frame() is None
+
+
+async def geocode_file(file_path, geocoder, concurrency=GEOCODER_CONCURRENCY, max_requests=MAX_REQUESTS, progress=None,
+                       resume=True, export=False, on_row=None, streaming=None, base=None, diff=True):
+    """Геокодирование строк Excel файла без координат и сохранение результата.
+
+    progress(строк готово, строк всего, ошибок) вызывается по мере получения
+    координат, on_row(индекс, адрес, широта, долгота, точность) - для каждой строки
+    сразу по готовности её адреса. Результаты пачками сбрасываются в CheckpointStore, поэтому
+    после сбоя они восстанавливаются, а при resume обработка продолжается с
+    первой необработанной строки. Результат сохраняется в колоночную копию,
+    а при export ещё и в xlsx. Большие книги (см. use_streaming) обрабатываются
+    geocode_file_streaming сразу в xlsx.
+
+    При diff строки сравниваются с прошлой обработанной версией той же базы
+    (base, по умолчанию - BaseSnapshots.default_base) по отпечаткам адресов: геокодируются
+    только новые и изменённые строки, остальные получают координаты из
+    прошлой версии. Строки, по которым не ответил ни один провайдер, остаются
+    без статуса и курсор контрольной точки не проходит дальше них; после
+    исчерпания квоты ключей новые запросы не делаются. Возвращает статистику:
+    запросов, строк, ошибок, перенесённых из прошлой версии, изменённых и
+    отложенных из-за отказа провайдеров строк.
+    """
+    checkpoints = CheckpointStore.open()
+    with stage('fingerprint'):
+        file_hash = await file_fingerprint(file_path)
+    if use_streaming(file_path, file_hash, streaming):
+        return await geocode_file_streaming(file_path, geocoder, concurrency, max_requests, progress, resume, on_row,
+                                            base, diff)
+    excel_handler = ExcelHandler(file_path, file_hash)
+
+    # Чтение Excel файла
+    with stage('read'):
+        await excel_handler.read_excel()
+        added = excel_handler.add_coordinates_column('Координаты')  # Указываем имя колонки
+        migrated = excel_handler.migrate_coordinates('Координаты')
+
+    # Восстановление результатов прошлого запуска, не попавших в файл
+    with stage('checkpoint'):
+        saved, start_row = checkpoints.load(file_hash)
+        saved = {index: value for index, value in saved.items()
+                 if index in excel_handler.dataframe.index and pd.isna(excel_handler.dataframe.at[index, ExcelHandler.LATITUDE_COLUMN])}
+        if saved:
+            excel_handler.set_coordinates(saved, 'Координаты')
+            logging.info(f"Восстановлено координат из контрольной точки: {len(saved)}")
+
+    # Сравнение с прошлой версией базы: не изменившиеся строки получают координаты без запросов
+    snapshots = BaseSnapshots.open()
+    base = base or BaseSnapshots.default_base(file_path)
+    fingerprints = None
+    copied = changed = 0
+    if diff and 'Адрес' in excel_handler.dataframe.columns:
+        with stage('diff'):
+            fingerprints = excel_handler.row_fingerprints('Адрес')
+            previous = snapshots.load(base)
+            if previous:
+                copied, changed = excel_handler.apply_snapshot(fingerprints, previous, 'Координаты')
+        if copied or changed:
+            logging.info(f"Сравнение с прошлой версией '{base}': перенесено координат {copied}, изменённых адресов {changed}")
+
+    # Строки, которым нужны координаты: с позиции продолжения, а если после неё
+    # ничего не осталось - заново по всему файлу, чтобы повторить неудачные адреса
+    with stage('select'):
+        pending = excel_handler.pending_addresses('Адрес', start_row if resume else 0)
+        if not pending and resume and start_row:
+            pending = excel_handler.pending_addresses('Адрес')
+        elif resume and start_row:
+            logging.info(f"Продолжение обработки со строки {start_row}")
+
+        # Один запрос на уникальный адрес, не больше max_requests запросов
+        groups = group_addresses(pending, limit=max_requests)
+    row_count = sum(len(indices) for _, indices in groups)
+    if row_count < len(pending):
+        logging.info(f"Достигнуто максимальное количество запросов ({max_requests}). Сохранение файла.")
+    # Строки до этой позиции (в порядке pending) попадают в группы целиком
+    end_row = pending[row_count][0] if row_count < len(pending) else len(excel_handler.dataframe)
+
+    # Позиция группы для каждой строки: по ней двигается курсор контрольной точки
+    row_groups = [None] * row_count
+    position_by_index = {}
+    for position, (_, indices) in enumerate(groups):
+        position_by_index.update(dict.fromkeys(indices, position))
+    for cursor, (index, _) in enumerate(pending[:row_count]):
+        row_groups[cursor] = position_by_index[index]
+
+    row_addresses = dict(pending[:row_count])
+    rows_done = 0
+    errors = unavailable = 0
+    finished = set()
+    batch = {}
+    cursor = 0
+
+    def flush():
+        nonlocal cursor
+        while cursor < row_count and row_groups[cursor] in finished:
+            cursor += 1
+        next_row = pending[cursor][0] if cursor < row_count else end_row
+        with stage('checkpoint'):
+            checkpoints.save(file_hash, batch, next_row)
+        batch.clear()
+
+    def on_result(position, result):
+        nonlocal rows_done, errors, unavailable
+        indices = groups[position][1]
+        # Не ответил ни один провайдер: группа не завершена, курсор останавливается перед ней
+        if result is None:
+            unavailable += len(indices)
+            return
+        latitude, longitude, precision = result
+        rows_done += len(indices)
+        finished.add(position)
+        if latitude is None or longitude is None:
+            errors += len(indices)
+        else:
+            batch.update(dict.fromkeys(indices, result))
+        if len(batch) >= CHECKPOINT_BATCH:
+            flush()
+        metrics.inc('rows_processed_total', len(indices))
+        if progress is not None:
+            progress(rows_done, row_count, errors)
+        if on_row is not None:
+            for index in indices:
+                on_row(index, row_addresses[index], latitude, longitude, precision)
+
+    # Получение координат параллельно и раздача результата всем строкам группы
+    with stage('geocode'):
+        results = await geocoder.get_coordinates_many([address for address, _ in groups], concurrency, on_result)
+    flush()
+    with stage('apply'):
+        coordinates = {}
+        for (_, indices), result in zip(groups, results):
+            if result is not None:
+                coordinates.update(dict.fromkeys(indices, result))
+        excel_handler.set_coordinates(coordinates, 'Координаты')
+
+    request_count = sum(result is not None for result in results)
+    if unavailable:
+        logging.warning(f"Провайдеры не ответили, строк отложено до следующего запуска: {unavailable}")
+
+    # Если ничего не поменялось, файлы не перезаписываются: xlsx сохраняет время
+    # изменения и ETag, и клиент, повторно опрашивающий /process, получает 304
+    modified = bool(added or migrated or saved or copied or changed or coordinates)
+    if modified:
+        # Сохранение результата в колоночную копию
+        with stage('save'):
+            await excel_handler.save()
+    if export:
+        with stage('export'):
+            if modified:
+                await excel_handler.save_excel()
+            else:
+                await excel_handler.export_excel()
+    # Координаты теперь в файле, в контрольной точке остаётся только позиция продолжения
+    checkpoints.clear_rows(file_hash)
+    if fingerprints is not None:
+        with stage('diff'):
+            snapshots.replace(base, file_hash, excel_handler.snapshot(fingerprints))
+    logging.info(f"Обработка завершена. Обработано запросов: {request_count}, строк: {rows_done}")
+    return {'requests': request_count, 'rows': rows_done, 'errors': errors, 'copied': copied, 'changed': changed,
+            'unavailable': unavailable}
+
+
+async def export_file(file_path):
+    """Перевыпуск xlsx из колоночной копии, если она новее файла."""
+    excel_handler = ExcelHandler(file_path, await file_fingerprint(file_path))
+    with stage('export'):
+        await excel_handler.export_excel()
@@ -0,0 +1,37 @@
+"""Пул для блокирующей работы с Excel вне event loop."""
+import asyncio
+import logging
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from .config import EXCEL_EXECUTOR, EXCEL_POOL_SIZE
+
+# Общий пул воркера: pd.read_excel и to_excel блокируют на секунды,
+# поэтому выполняются в нём, а не в event loop
+executor = None
+
+
+def open_executor():
+    """Создание пула потоков или процессов для работы с Excel."""
+    global executor
+    if executor is None:
+        if EXCEL_EXECUTOR == 'process':
+            executor = ProcessPoolExecutor(max_workers=EXCEL_POOL_SIZE)
+        else:
+            executor = ThreadPoolExecutor(max_workers=EXCEL_POOL_SIZE, thread_name_prefix='excel')
+        logging.info(f"Пул Excel открыт ({EXCEL_EXECUTOR}, {EXCEL_POOL_SIZE}).")
+    return executor
+
+
+def close_executor():
+    """Остановка пула при остановке приложения."""
+    global executor
+    if executor is not None:
+        executor.shutdown(wait=True)
+        executor = None
+        logging.info("Пул Excel закрыт.")
+
+
+async def run_in_executor(function, *args):
+    """Выполнение блокирующей функции в пуле Excel."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(open_executor(), function, *args)
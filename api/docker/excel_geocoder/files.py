@@ -0,0 +1,77 @@
+"""Хэши загруженных файлов."""
+import asyncio
+import hashlib
+import logging
+import os
+import uuid
+
+from .config import UPLOAD_CHUNK_SIZE
+
+
+def file_sha256(file_path):
+    """SHA-256 содержимого файла, читается блоками."""
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as file:
+        for chunk in iter(lambda: file.read(UPLOAD_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def file_state(file_path):
+    """Размер и время изменения файла одной строкой: по ним видно, что файл заменили."""
+    stat = os.stat(file_path)
+    return f"{stat.st_size} {stat.st_mtime_ns}"
+
+
+def read_fingerprint(file_path):
+    """Хэш и состояние файла (см. file_state) из <имя>.sha256.
+
+    (None, None), если хэша нет; в файлах старого формата записан только
+    хэш, и состояние - None.
+    """
+    try:
+        with open(f"{file_path}.sha256", 'r') as f:
+            lines = f.read().splitlines()
+    except FileNotFoundError:
+        return None, None
+    if not lines or not lines[0].strip():
+        return None, None
+    return lines[0].strip(), (lines[1].strip() or None) if len(lines) > 1 else None
+
+
+def write_fingerprint(file_path, sha256):
+    """Запись хэша загрузки и текущего состояния файла в <имя>.sha256."""
+    hash_path = f"{file_path}.sha256"
+    temp_path = f"{hash_path}.{uuid.uuid4().hex}.tmp"
+    with open(temp_path, 'w') as f:
+        f.write(f"{sha256}\n{file_state(file_path)}\n")
+    os.replace(temp_path, hash_path)
+
+
+def record_write(file_path):
+    """Отметка, что файл перезаписан сервисом: хэш загрузки остаётся прежним, состояние обновляется."""
+    sha256, _ = read_fingerprint(file_path)
+    if sha256 is not None:
+        write_fingerprint(file_path, sha256)
+
+
+async def file_fingerprint(file_path):
+    """Хэш исходной загрузки файла.
+
+    Берётся из файла <имя>.sha256, который пишет /upload: запись координат в
+    сам файл хэш не меняет, потому что после каждой такой записи в <имя>.sha256
+    обновляется и состояние файла (record_write). Если состояние не совпадает,
+    файл заменили в обход сервиса, и хэш считается заново; для файлов без
+    <имя>.sha256 - тоже. В файлах старого формата состояния нет: хэш
+    принимается и дописывается текущее состояние.
+    """
+    sha256, state = read_fingerprint(file_path)
+    if sha256 is not None and state in (None, file_state(file_path)):
+        if state is None:
+            write_fingerprint(file_path, sha256)
+        return sha256
+    if sha256 is not None:
+        logging.info(f"Файл {file_path} изменён в обход сервиса, хэш пересчитывается")
+    sha256 = await asyncio.get_running_loop().run_in_executor(None, file_sha256, file_path)
+    write_fingerprint(file_path, sha256)
+    return sha256
@@ -0,0 +1,165 @@
+"""Метрики воркера в формате Prometheus."""
+import asyncio
+import contextlib
+import json
+import logging
+import os
+import sqlite3
+import time
+
+from .config import METRICS_FLUSH_INTERVAL, METRICS_PATH, METRICS_STALE_AFTER
+from .db import open_sqlite
+
+
+class Metrics:
+    """Счётчики, текущие значения и гистограммы в текстовом формате Prometheus.
+
+    Значения копятся в памяти воркера без блокировок и раз в
+    METRICS_FLUSH_INTERVAL сбрасываются снимком в SQLite под pid воркера;
+    /metrics суммирует снимки всех живых воркеров.
+    """
+
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+    HELP = {
+        'geocoder_request_seconds': 'Latency of upstream geocoder HTTP requests',
+        'geocoder_requests_total': 'Upstream geocoder HTTP requests by result',
+        'geocoder_errors_total': 'Geocoding errors by type',
+        'geocoder_in_flight': 'Upstream geocoder requests in flight',
+        'geocode_cache_hits_total': 'Geocode cache hits',
+        'geocode_cache_misses_total': 'Geocode cache misses',
+        'excel_io_seconds': 'Duration of workbook read/write operations',
+        'rows_processed_total': 'Rows geocoded by /process; use rate() for rows per second',
+        'http_requests_in_flight': 'HTTP requests being served',
+        'geocode_cache_hit_ratio': 'Share of lookups answered from the geocode cache',
+        'geocoder_quota_remaining': 'Geocoder requests left in today\'s quota',
+        'geocoder_provider_results_total': 'Geocoding attempts by provider and result',
+        'geocoder_hedged_total': 'Lookups that fired a hedged request to the next provider',
+        'geocoder_key_rotations_total': 'API keys taken out of rotation after a quota error',
+    }
+
+    def __init__(self, db_path=METRICS_PATH):
+        self.db_path = db_path
+        self.connection = None
+        self.counters = {}  # имя -> {метки: значение}
+        self.gauges = {}
+        self.histograms = {}  # имя -> {метки: [счётчики корзин..., сумма, количество]}
+
+    @staticmethod
+    def labels(labels):
+        return ','.join(f'{key}="{value}"' for key, value in sorted(labels.items()))
+
+    def inc(self, name, amount=1, **labels):
+        series = self.counters.setdefault(name, {})
+        key = self.labels(labels)
+        series[key] = series.get(key, 0) + amount
+
+    def add(self, name, amount, **labels):
+        """Изменение текущего значения (gauge) на amount."""
+        series = self.gauges.setdefault(name, {})
+        key = self.labels(labels)
+        series[key] = series.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        series = self.histograms.setdefault(name, {})
+        key = self.labels(labels)
+        buckets = series.setdefault(key, [0] * (len(self.BUCKETS) + 2))
+        for position, bound in enumerate(self.BUCKETS):
+            if value <= bound:
+                buckets[position] += 1
+        buckets[-2] += value
+        buckets[-1] += 1
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        """Замер длительности блока в гистограмму name."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def open(self):
+        if self.connection is None:
+            self.connection = open_sqlite(self.db_path)
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS snapshots (pid INTEGER PRIMARY KEY, snapshot TEXT NOT NULL, updated REAL NOT NULL)'
+            )
+        return self.connection
+
+    def flush(self):
+        """Запись снимка значений текущего воркера."""
+        snapshot = json.dumps({'counter': self.counters, 'gauge': self.gauges, 'histogram': self.histograms})
+        self.open().execute(
+            'INSERT OR REPLACE INTO snapshots (pid, snapshot, updated) VALUES (?, ?, ?)',
+            (os.getpid(), snapshot, time.time())
+        )
+
+    def close(self):
+        if self.connection is not None:
+            self.flush()
+            self.connection.close()
+            self.connection = None
+
+    def collect(self):
+        """Сумма снимков всех живых воркеров."""
+        self.flush()
+        total = {'counter': {}, 'gauge': {}, 'histogram': {}}
+        rows = self.open().execute(
+            'SELECT snapshot FROM snapshots WHERE updated >= ?', (time.time() - METRICS_STALE_AFTER,)
+        ).fetchall()
+        for (snapshot,) in rows:
+            snapshot = json.loads(snapshot)
+            for kind in ('counter', 'gauge'):
+                for name, series in snapshot[kind].items():
+                    target = total[kind].setdefault(name, {})
+                    for key, value in series.items():
+                        target[key] = target.get(key, 0) + value
+            for name, series in snapshot['histogram'].items():
+                target = total['histogram'].setdefault(name, {})
+                for key, buckets in series.items():
+                    current = target.setdefault(key, [0] * len(buckets))
+                    target[key] = [a + b for a, b in zip(current, buckets)]
+        return total
+
+    def render(self, extra_gauges=None):
+        """Текст для /metrics; extra_gauges - значения, общие для всех воркеров."""
+        total = self.collect()
+        hits = sum(total['counter'].get('geocode_cache_hits_total', {}).values())
+        misses = sum(total['counter'].get('geocode_cache_misses_total', {}).values())
+        total['gauge']['geocode_cache_hit_ratio'] = {'': hits / (hits + misses) if hits + misses else 0.0}
+        for name, value in (extra_gauges or {}).items():
+            total['gauge'][name] = {'': value}
+
+        lines = []
+        for kind in ('counter', 'gauge'):
+            for name, series in sorted(total[kind].items()):
+                if name in self.HELP:
+                    lines.append(f'# HELP {name} {self.HELP[name]}')
+                lines.append(f'# TYPE {name} {kind}')
+                for key, value in sorted(series.items()):
+                    lines.append(f'{name}{{{key}}} {value}' if key else f'{name} {value}')
+        for name, series in sorted(total['histogram'].items()):
+            if name in self.HELP:
+                lines.append(f'# HELP {name} {self.HELP[name]}')
+            lines.append(f'# TYPE {name} histogram')
+            for key, buckets in sorted(series.items()):
+                prefix = f'{key},' if key else ''
+                for bound, count in zip(self.BUCKETS, buckets):
+                    lines.append(f'{name}_bucket{{{prefix}le="{bound}"}} {count}')
+                lines.append(f'{name}_bucket{{{prefix}le="+Inf"}} {buckets[-1]}')
+                suffix = f'{{{key}}}' if key else ''
+                lines.append(f'{name}_sum{suffix} {buckets[-2]}')
+                lines.append(f'{name}_count{suffix} {buckets[-1]}')
+        return '\n'.join(lines) + '\n'
+
+    async def run_flusher(self):
+        """Фоновый сброс снимка воркера."""
+        while True:
+            await asyncio.sleep(METRICS_FLUSH_INTERVAL)
+            try:
+                self.flush()
+            except sqlite3.Error as e:
+                logging.error(f"Ошибка записи метрик: {str(e)}")
+
+
+metrics = Metrics()
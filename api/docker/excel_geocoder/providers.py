@@ -0,0 +1,177 @@
+"""Провайдеры геокодирования: Yandex, Nominatim и локальный справочник."""
+import asyncio
+import csv
+import logging
+import os
+import time
+
+import aiohttp
+
+from .addresses import normalize_address
+from .config import (GAZETTEER_PATH, GEOCODER_BACKOFF_BASE, GEOCODER_FAILOVER_COOLDOWN, GEOCODER_RETRIES,
+                     GEOCODER_URL, NOMINATIM_URL)
+from .metrics import metrics
+
+
+class ProviderUnavailable(Exception):
+    """Провайдер сейчас не может ответить: квота, перегрузка, сетевая ошибка."""
+
+
+class QuotaExhausted(ProviderUnavailable):
+    """Дневная квота всех ключей исчерпана: до её сброса запросы бесполезны."""
+
+
+class GeocoderProvider:
+    """Источник координат для AddressGeocoder.
+
+    geocode(session, address) возвращает (широта, долгота, точность) или None, если
+    адрес не найден, и бросает ProviderUnavailable, если провайдер не может
+    ответить. Отказавший провайдер GEOCODER_FAILOVER_COOLDOWN секунд
+    опрашивается последним; состояние общее для всех запросов воркера.
+    """
+
+    name = None
+    down_until = {}  # имя провайдера -> до какого момента (monotonic) считать его отказавшим
+
+    def available(self):
+        return time.monotonic() >= self.down_until.get(self.name, 0)
+
+    def mark_down(self):
+        self.down_until[self.name] = time.monotonic() + GEOCODER_FAILOVER_COOLDOWN
+
+    async def geocode(self, session, address):
+        raise NotImplementedError
+
+
+class YandexProvider(GeocoderProvider):
+    """Yandex Geocoder API с пулом ключей, общим ограничителем частоты и повторами после 429/5xx."""
+
+    name = 'yandex'
+
+    def __init__(self, keys, limiter=None):
+        self.keys = keys
+        self.limiter = limiter
+
+    async def geocode(self, session, address):
+        attempt = 0
+        while attempt <= GEOCODER_RETRIES:
+            if self.limiter is not None:
+                await self.limiter.acquire()
+            key = self.keys.acquire()
+            if key is None:
+                metrics.inc('geocoder_errors_total', type='quota')
+                raise QuotaExhausted("дневная квота всех ключей исчерпана")
+            key_id, api_key = key
+            params = {
+                'geocode': address,
+                'format': 'json',
+                'apikey': api_key
+            }
+
+            metrics.add('geocoder_in_flight', 1)
+            start = time.perf_counter()
+            try:
+                async with session.get(GEOCODER_URL, params=params) as response:
+                    metrics.observe('geocoder_request_seconds', time.perf_counter() - start, provider=self.name)
+                    metrics.inc('geocoder_requests_total', status=response.status)
+                    # Ключ заблокирован или исчерпал квоту: повторяем с другим ключом
+                    if response.status == 403:
+                        metrics.inc('geocoder_errors_total', type='quota')
+                        self.keys.exhaust(key_id)
+                        continue
+                    # Перегрузка или сбой на стороне API: пауза и повтор
+                    if response.status == 429 or response.status >= 500:
+                        logging.warning(f"API ответил {response.status} для адреса {address} (попытка {attempt + 1}).")
+                        metrics.inc('geocoder_errors_total', type='http_429' if response.status == 429 else 'http_5xx')
+                        if self.limiter is not None:
+                            self.limiter.backoff(response.headers.get('Retry-After'))
+                        else:
+                            await asyncio.sleep(GEOCODER_BACKOFF_BASE * 2 ** attempt)
+                        attempt += 1
+                        continue
+
+                    response.raise_for_status()  # Проверяем, что запрос успешен
+                    data = await response.json()
+                    if self.limiter is not None:
+                        self.limiter.recover()
+
+                    if 'response' in data and data['response']['GeoObjectCollection']['featureMember']:
+                        geo_object = data['response']['GeoObjectCollection']['featureMember'][0]['GeoObject']
+                        lon, lat = map(float, geo_object['Point']['pos'].split())  # Долгота, широта
+                        meta = geo_object.get('metaDataProperty', {}).get('GeocoderMetaData', {})
+                        return lat, lon, meta.get('precision')
+                    metrics.inc('geocoder_errors_total', type='not_found')
+                    return None
+            except asyncio.TimeoutError as e:
+                metrics.inc('geocoder_errors_total', type='timeout')
+                raise ProviderUnavailable(f"таймаут запроса: {str(e)}")
+            except aiohttp.ClientError as e:
+                metrics.inc('geocoder_errors_total', type='client')
+                raise ProviderUnavailable(f"ошибка запроса: {str(e)}")
+            finally:
+                metrics.add('geocoder_in_flight', -1)
+
+        metrics.inc('geocoder_errors_total', type='retries_exhausted')
+        raise ProviderUnavailable(f"API недоступен после {GEOCODER_RETRIES + 1} попыток")
+
+
+class NominatimProvider(GeocoderProvider):
+    """Nominatim (OpenStreetMap). Публичный сервер разрешает 1 запрос в секунду,
+    для потоковой обработки NOMINATIM_URL должен указывать на свой экземпляр."""
+
+    name = 'nominatim'
+
+    def __init__(self, url=NOMINATIM_URL):
+        self.url = url
+
+    async def geocode(self, session, address):
+        params = {'q': address, 'format': 'json', 'limit': 1}
+        headers = {'User-Agent': 'excel-geocoder'}
+        start = time.perf_counter()
+        try:
+            async with session.get(self.url, params=params, headers=headers) as response:
+                metrics.observe('geocoder_request_seconds', time.perf_counter() - start, provider=self.name)
+                if response.status == 429 or response.status >= 500:
+                    raise ProviderUnavailable(f"API ответил {response.status}")
+                response.raise_for_status()
+                data = await response.json()
+        except asyncio.TimeoutError as e:
+            raise ProviderUnavailable(f"таймаут запроса: {str(e)}")
+        except aiohttp.ClientError as e:
+            raise ProviderUnavailable(f"ошибка запроса: {str(e)}")
+        if not data:
+            return None
+        return float(data[0]['lat']), float(data[0]['lon']), data[0].get('addresstype') or data[0].get('type')
+
+
+class GazetteerProvider(GeocoderProvider):
+    """Локальный справочник адресов без сети: CSV с колонками address, latitude, longitude
+    и необязательной precision.
+
+    Файл читается один раз на воркер, поиск идёт по нормализованному адресу.
+    """
+
+    name = 'gazetteer'
+    index = None
+
+    @classmethod
+    def load(cls, path=GAZETTEER_PATH):
+        if cls.index is not None:
+            return cls.index
+        cls.index = {}
+        if not os.path.exists(path):
+            logging.warning(f"Справочник адресов {path} не найден, провайдер gazetteer ничего не найдёт.")
+            return cls.index
+        with open(path, 'r', encoding='utf-8', newline='') as file:
+            for row in csv.DictReader(file):
+                try:
+                    cls.index[normalize_address(row['address'])] = (
+                        float(row['latitude']), float(row['longitude']), row.get('precision') or None
+                    )
+                except (KeyError, TypeError, ValueError):
+                    continue
+        logging.info(f"Справочник адресов загружен: {len(cls.index)} записей.")
+        return cls.index
+
+    async def geocode(self, session, address):
+        return self.load().get(normalize_address(address))
@@ -0,0 +1,171 @@
+"""Пространственный индекс уже найденных координат."""
+import asyncio
+import glob
+import logging
+import os
+
+import numpy as np
+import pandas as pd
+
+from . import executor
+from .config import EARTH_RADIUS_KM, SPATIAL_CELL, SPATIAL_INDEX_SOURCES, SPATIAL_REVERSE_RADIUS
+from .excel import ExcelHandler, parse_coordinates
+
+
+def haversine_km(latitude, longitude, latitudes, longitudes):
+    """Расстояния от точки до массива точек по большому кругу, км."""
+    lat1, lon1 = np.radians(latitude), np.radians(longitude)
+    lat2, lon2 = np.radians(latitudes), np.radians(longitudes)
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+class SpatialIndex:
+    """Индекс уже найденных координат для запросов без обращения к внешнему API.
+
+    Точки раскладываются по сетке ячеек SPATIAL_CELL градусов: массивы NumPy
+    упорядочены по номеру ячейки, для каждой ячейки хранится её срез. Поиск
+    ближайших просматривает ячейки кольцами вокруг точки запроса, пока
+    следующее кольцо заведомо не может дать точку ближе найденных; для
+    прямоугольника используется сортировка по широте и бинарный поиск.
+    """
+
+    # Индекс воркера, строится при первом запросе к /spatial
+    shared = None
+    # Дальше этого кольца перебор всех точек дешевле обхода ячеек
+    MAX_RINGS = 8
+
+    def __init__(self, latitudes, longitudes, addresses, sources, cell=SPATIAL_CELL):
+        latitudes = np.asarray(latitudes, dtype='float64')
+        longitudes = np.asarray(longitudes, dtype='float64')
+        valid = np.isfinite(latitudes) & np.isfinite(longitudes) & (np.abs(latitudes) <= 90) & (np.abs(longitudes) <= 180)
+        self.cell = cell
+
+        rows = np.floor(latitudes[valid] / cell).astype('int64')
+        cols = np.floor(longitudes[valid] / cell).astype('int64')
+        keys = rows * 1000000 + cols
+        order = np.argsort(keys, kind='stable')
+        self.latitudes = latitudes[valid][order]
+        self.longitudes = longitudes[valid][order]
+        self.addresses = np.asarray(addresses, dtype=object)[valid][order]
+        self.sources = np.asarray(sources, dtype=object)[valid][order]
+
+        unique, starts, counts = np.unique(keys[order], return_index=True, return_counts=True)
+        self.cells = {int(key): (int(start), int(start + count)) for key, start, count in zip(unique, starts, counts)}
+
+        self.by_latitude = np.argsort(self.latitudes, kind='stable')
+        self.sorted_latitudes = self.latitudes[self.by_latitude]
+
+    def __len__(self):
+        return len(self.latitudes)
+
+    @classmethod
+    def from_files(cls, patterns=SPATIAL_INDEX_SOURCES, address_column_name='Адрес', coordinates_column_name='Координаты'):
+        """Сбор точек из обработанных листов; файлы без нужных колонок пропускаются."""
+        latitudes, longitudes, addresses, sources = [], [], [], []
+        paths = sorted({path for pattern in patterns.split(',') if pattern.strip() for path in glob.glob(pattern.strip())})
+        for path in paths:
+            try:
+                dataframe = pd.read_excel(path)
+            except Exception as e:
+                logging.warning(f"Файл {path} пропущен при построении индекса: {str(e)}")
+                continue
+            if address_column_name not in dataframe.columns:
+                continue
+            if ExcelHandler.LATITUDE_COLUMN in dataframe.columns and ExcelHandler.LONGITUDE_COLUMN in dataframe.columns:
+                lat = pd.to_numeric(dataframe[ExcelHandler.LATITUDE_COLUMN], errors='coerce').to_numpy(dtype='float64')
+                lon = pd.to_numeric(dataframe[ExcelHandler.LONGITUDE_COLUMN], errors='coerce').to_numpy(dtype='float64')
+            elif coordinates_column_name in dataframe.columns:
+                lat, lon = parse_coordinates(dataframe[coordinates_column_name])
+            else:
+                continue
+            latitudes.append(lat)
+            longitudes.append(lon)
+            addresses.append(dataframe[address_column_name].to_numpy(dtype=object))
+            sources.append(np.full(len(dataframe), os.path.basename(path), dtype=object))
+
+        if not latitudes:
+            return cls(np.empty(0), np.empty(0), np.empty(0, dtype=object), np.empty(0, dtype=object))
+        return cls(np.concatenate(latitudes), np.concatenate(longitudes), np.concatenate(addresses), np.concatenate(sources))
+
+    @classmethod
+    async def load_shared(cls, patterns=SPATIAL_INDEX_SOURCES):
+        """Построение индекса воркера в пуле Excel, чтобы не блокировать event loop."""
+        loop = asyncio.get_running_loop()
+        cls.shared = await loop.run_in_executor(executor.open_executor(), cls.from_files, patterns)
+        logging.info(f"Пространственный индекс построен: {len(cls.shared)} точек, {len(cls.shared.cells)} ячеек.")
+        return cls.shared
+
+    def point(self, position, distance=None):
+        address = self.addresses[position]
+        result = {
+            'address': address if isinstance(address, str) else None,
+            'latitude': float(self.latitudes[position]),
+            'longitude': float(self.longitudes[position]),
+            'source': self.sources[position],
+        }
+        if distance is not None:
+            result['distance_km'] = round(float(distance), 4)
+        return result
+
+    def ring(self, row, col, radius):
+        """Позиции точек в ячейках на расстоянии ровно radius ячеек от (row, col)."""
+        slices = []
+        for r in range(row - radius, row + radius + 1):
+            step = 1 if abs(r - row) == radius else 2 * radius
+            for c in range(col - radius, col + radius + 1, max(1, step)):
+                bounds = self.cells.get(r * 1000000 + c)
+                if bounds is not None:
+                    slices.append(np.arange(*bounds))
+        return slices
+
+    def nearest(self, latitude, longitude, count=1):
+        """Ближайшие count точек: [(позиция, расстояние, км)] по возрастанию расстояния."""
+        if len(self) == 0 or count < 1:
+            return []
+        row = int(np.floor(latitude / self.cell))
+        col = int(np.floor(longitude / self.cell))
+        candidates = []
+        for radius in range(self.MAX_RINGS + 1):
+            candidates.extend(self.ring(row, col, radius))
+            if not candidates:
+                continue
+            positions = np.concatenate(candidates)
+            if len(positions) < count:
+                continue
+            distances = haversine_km(latitude, longitude, self.latitudes[positions], self.longitudes[positions])
+            top = np.argpartition(distances, count - 1)[:count]
+            # Любая точка за пределами просмотренных колец дальше этой границы
+            shrink = max(np.cos(np.radians(min(89.9, abs(latitude) + (radius + 1) * self.cell))), 0.01)
+            bound = radius * self.cell * np.radians(1) * EARTH_RADIUS_KM * shrink
+            if distances[top].max() <= bound:
+                ordered = top[np.argsort(distances[top], kind='stable')]
+                return [(int(positions[i]), float(distances[i])) for i in ordered]
+
+        # Редкие точки: проще перебрать все
+        distances = haversine_km(latitude, longitude, self.latitudes, self.longitudes)
+        count = min(count, len(distances))
+        top = np.argpartition(distances, count - 1)[:count]
+        ordered = top[np.argsort(distances[top], kind='stable')]
+        return [(int(i), float(distances[i])) for i in ordered]
+
+    def reverse(self, latitude, longitude, radius_km=SPATIAL_REVERSE_RADIUS):
+        """Адрес ближайшей известной точки не дальше radius_km или None."""
+        found = self.nearest(latitude, longitude, 1)
+        if not found or found[0][1] > radius_km:
+            return None
+        return self.point(*found[0])
+
+    def bbox(self, south, west, north, east, limit=None):
+        """Точки в прямоугольнике; west > east означает переход через 180-й меридиан."""
+        start = np.searchsorted(self.sorted_latitudes, south, side='left')
+        end = np.searchsorted(self.sorted_latitudes, north, side='right')
+        positions = self.by_latitude[start:end]
+        longitudes = self.longitudes[positions]
+        if west <= east:
+            positions = positions[(longitudes >= west) & (longitudes <= east)]
+        else:
+            positions = positions[(longitudes >= west) | (longitudes <= east)]
+        if limit is not None:
+            positions = positions[:limit]
+        return [self.point(position) for position in positions]
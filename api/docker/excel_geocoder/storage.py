@@ -0,0 +1,526 @@
+"""Общие для воркеров хранилища в SQLite: кэш координат, ограничитель частоты,
+пул ключей и контрольные точки обработки."""
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import time
+import uuid
+
+from .addresses import normalize_address
+from .config import (BASE_SNAPSHOT_PATH, CHECKPOINT_PATH, GEOCODE_CACHE_MAX_ENTRIES, GEOCODE_CACHE_PATH, GEOCODE_CACHE_TTL,
+                     GEOCODER_BACKOFF_BASE, GEOCODER_BACKOFF_MAX, GEOCODER_BURST, GEOCODER_DAILY_LIMIT,
+                     GEOCODER_KEY_STRATEGY, GEOCODER_KEYS_FILE, GEOCODER_RATE, RATE_LIMIT_PATH, UPLOAD_FOLDER)
+from .db import open_sqlite
+from .metrics import metrics
+
+
+class GeocodeCache:
+    """Постоянный кэш адрес -> координаты в SQLite с TTL и вытеснением старых записей."""
+
+    EVICT_EVERY = 1000  # Проверка размера кэша раз в столько новых записей
+
+    def __init__(self, db_path=GEOCODE_CACHE_PATH, ttl=GEOCODE_CACHE_TTL, max_entries=GEOCODE_CACHE_MAX_ENTRIES):
+        self.db_path = db_path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+
+        self.connection = open_sqlite(db_path)
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS geocode ('
+            'key TEXT PRIMARY KEY, latitude REAL NOT NULL, longitude REAL NOT NULL, created REAL NOT NULL, precision TEXT)'
+        )
+        columns = [row[1] for row in self.connection.execute('PRAGMA table_info(geocode)')]
+        if 'precision' not in columns:
+            self.connection.execute('ALTER TABLE geocode ADD COLUMN precision TEXT')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS geocode_created ON geocode (created)')
+        self.evict()
+
+    def get(self, address):
+        """(широта, долгота, точность) из кэша или None, если записи нет или она устарела."""
+        row = self.connection.execute(
+            'SELECT latitude, longitude, precision FROM geocode WHERE key = ? AND created >= ?',
+            (normalize_address(address), time.time() - self.ttl)
+        ).fetchone()
+        if row is None:
+            self.misses += 1
+            metrics.inc('geocode_cache_misses_total')
+            return None
+        self.hits += 1
+        metrics.inc('geocode_cache_hits_total')
+        return row[0], row[1], row[2]
+
+    def set(self, address, latitude, longitude, precision=None):
+        """Сохранение найденных координат."""
+        self.connection.execute(
+            'INSERT OR REPLACE INTO geocode (key, latitude, longitude, created, precision) VALUES (?, ?, ?, ?, ?)',
+            (normalize_address(address), latitude, longitude, time.time(), precision)
+        )
+        self.writes += 1
+        if self.writes % self.EVICT_EVERY == 0:
+            self.evict()
+
+    def evict(self):
+        """Удаление устаревших записей и самых старых сверх max_entries."""
+        self.connection.execute('DELETE FROM geocode WHERE created < ?', (time.time() - self.ttl,))
+        self.connection.execute(
+            'DELETE FROM geocode WHERE key IN ('
+            'SELECT key FROM geocode ORDER BY created DESC LIMIT -1 OFFSET ?)',
+            (self.max_entries,)
+        )
+
+    def stats(self):
+        """Счётчики попаданий и промахов текущего воркера."""
+        total = self.hits + self.misses
+        entries = self.connection.execute('SELECT COUNT(*) FROM geocode').fetchone()[0]
+        return {
+            'entries': entries,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hits / total if total else 0.0
+        }
+
+    def close(self):
+        self.connection.close()
+
+
+class RateLimiter:
+    """Token bucket, общий для всех воркеров через SQLite.
+
+    Корзина пополняется со скоростью rate токенов в секунду до burst; каждый
+    запрос к API забирает токен. После 429/5xx все воркеры выдерживают общую
+    паузу с экспоненциальным ростом. Дневные квоты считает KeyPool по ключам.
+    """
+
+    def __init__(self, db_path=RATE_LIMIT_PATH, rate=GEOCODER_RATE, burst=GEOCODER_BURST):
+        self.rate = rate
+        self.burst = burst
+
+        self.connection = open_sqlite(db_path)
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS bucket ('
+            'id INTEGER PRIMARY KEY CHECK (id = 1), tokens REAL NOT NULL, updated REAL NOT NULL, '
+            'blocked_until REAL NOT NULL DEFAULT 0, failures INTEGER NOT NULL DEFAULT 0)'
+        )
+        self.connection.execute('INSERT OR IGNORE INTO bucket (id, tokens, updated) VALUES (1, ?, ?)', (burst, time.time()))
+
+    def try_acquire(self):
+        """Попытка взять токен: 0 - взят, иначе сколько ждать."""
+        self.connection.execute('BEGIN IMMEDIATE')
+        try:
+            tokens, updated, blocked_until = self.connection.execute(
+                'SELECT tokens, updated, blocked_until FROM bucket WHERE id = 1'
+            ).fetchone()
+
+            now = time.time()
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            if blocked_until > now:
+                wait = blocked_until - now
+            elif tokens >= 1:
+                tokens -= 1
+                wait = 0
+            else:
+                wait = (1 - tokens) / self.rate
+
+            self.connection.execute('UPDATE bucket SET tokens = ?, updated = ? WHERE id = 1', (tokens, now))
+            self.connection.execute('COMMIT')
+        except Exception:
+            self.connection.execute('ROLLBACK')
+            raise
+        return wait
+
+    async def acquire(self):
+        """Ожидание токена."""
+        while True:
+            wait = self.try_acquire()
+            if wait == 0:
+                return
+            await asyncio.sleep(wait)
+
+    def backoff(self, retry_after=None):
+        """Общая пауза после 429/5xx: по Retry-After или с экспоненциальным ростом."""
+        self.connection.execute('BEGIN IMMEDIATE')
+        try:
+            failures = self.connection.execute('SELECT failures FROM bucket WHERE id = 1').fetchone()[0] + 1
+            try:
+                delay = float(retry_after)
+            except (TypeError, ValueError):
+                delay = min(GEOCODER_BACKOFF_MAX, GEOCODER_BACKOFF_BASE * 2 ** (failures - 1))
+            self.connection.execute(
+                'UPDATE bucket SET failures = ?, blocked_until = MAX(blocked_until, ?) WHERE id = 1',
+                (failures, time.time() + delay)
+            )
+            self.connection.execute('COMMIT')
+        except Exception:
+            self.connection.execute('ROLLBACK')
+            raise
+        logging.warning(f"Геокодер перегружен, пауза {delay:.1f} с (ошибок подряд: {failures}).")
+        return delay
+
+    def recover(self):
+        """Сброс счётчика ошибок после успешного ответа."""
+        self.connection.execute('UPDATE bucket SET failures = 0 WHERE id = 1 AND failures > 0')
+
+    def close(self):
+        self.connection.close()
+
+
+class KeyPool:
+    """Пул API ключей с дневной квотой на каждый ключ, общий для всех воркеров через SQLite.
+
+    Файл ключей читается один раз на воркер: по ключу на строку, через пробел
+    можно указать дневной лимит ключа (по умолчанию GEOCODER_DAILY_LIMIT).
+    Расход хранится по хэшу ключа, сам ключ в базу не пишется. Стратегия
+    'round_robin' выдаёт ключ с наименьшим расходом за сегодня, 'drain'
+    расходует ключи по порядку. Ключ, получивший отказ по квоте, до конца
+    суток больше не выдаётся.
+    """
+
+    STRATEGIES = ('round_robin', 'drain')
+    # Пулы воркера по полному пути к файлу ключей
+    pools = {}
+
+    def __init__(self, keys, db_path=RATE_LIMIT_PATH, strategy=GEOCODER_KEY_STRATEGY):
+        if strategy not in self.STRATEGIES:
+            raise Exception(f"Неизвестная стратегия выбора ключа: {strategy}")
+        if not keys:
+            raise Exception("В пуле нет ни одного API ключа.")
+        self.keys = keys  # [(id ключа, ключ, дневной лимит)]
+        self.strategy = strategy
+
+        self.connection = open_sqlite(db_path)
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS key_usage ('
+            'key_id TEXT NOT NULL, day TEXT NOT NULL, used INTEGER NOT NULL, PRIMARY KEY (key_id, day))'
+        )
+
+    @staticmethod
+    def read(file_path):
+        """Чтение ключей из файла: [(id ключа, ключ, дневной лимит)]."""
+        try:
+            with open(file_path, 'r', encoding='utf-8') as file:
+                lines = [line.split() for line in file if line.strip() and not line.startswith('#')]
+        except FileNotFoundError:
+            raise Exception(f"Файл {file_path} не найден.")
+        except Exception as e:
+            raise Exception(f"Ошибка чтения API ключа: {str(e)}")
+
+        keys = []
+        for parts in lines:
+            key = parts[0]
+            limit = int(parts[1]) if len(parts) > 1 else GEOCODER_DAILY_LIMIT
+            keys.append((hashlib.sha256(key.encode('utf-8')).hexdigest()[:16], key, limit))
+        return keys
+
+    @classmethod
+    def shared(cls, file_path=GEOCODER_KEYS_FILE):
+        """Пул для файла ключей: читается при первом обращении и дальше переиспользуется.
+
+        Пулы различаются по полному пути: './apikey.txt' и 'apikey.txt' - один пул.
+        """
+        path = os.path.realpath(file_path)
+        pool = cls.pools.get(path)
+        if pool is None:
+            pool = cls.pools[path] = cls(cls.read(file_path))
+            logging.info(f"Загружено API ключей из {file_path}: {len(pool.keys)} (стратегия {pool.strategy}).")
+        return pool
+
+    @classmethod
+    def close_shared(cls):
+        for pool in cls.pools.values():
+            pool.close()
+        cls.pools = {}
+
+    def used_today(self):
+        day = time.strftime('%Y-%m-%d')
+        return dict(self.connection.execute('SELECT key_id, used FROM key_usage WHERE day = ?', (day,)).fetchall())
+
+    def acquire(self):
+        """Ключ для следующего запроса (id ключа, ключ) или None, если квоты всех ключей исчерпаны."""
+        day = time.strftime('%Y-%m-%d')
+        self.connection.execute('BEGIN IMMEDIATE')
+        try:
+            used = self.used_today()
+            candidates = [(key_id, key) for key_id, key, limit in self.keys if used.get(key_id, 0) < limit]
+            if not candidates:
+                chosen = None
+            elif self.strategy == 'round_robin':
+                chosen = min(candidates, key=lambda candidate: used.get(candidate[0], 0))
+            else:
+                chosen = candidates[0]
+
+            if chosen is not None:
+                self.connection.execute(
+                    'INSERT INTO key_usage (key_id, day, used) VALUES (?, ?, 1) '
+                    'ON CONFLICT(key_id, day) DO UPDATE SET used = used + 1',
+                    (chosen[0], day)
+                )
+            self.connection.execute('COMMIT')
+        except Exception:
+            self.connection.execute('ROLLBACK')
+            raise
+        return chosen
+
+    def exhaust(self, key_id):
+        """Отказ API по квоте: ключ считается израсходованным до конца суток."""
+        limit = next(limit for candidate, _, limit in self.keys if candidate == key_id)
+        self.connection.execute(
+            'INSERT INTO key_usage (key_id, day, used) VALUES (?, ?, ?) '
+            'ON CONFLICT(key_id, day) DO UPDATE SET used = MAX(used, excluded.used)',
+            (key_id, time.strftime('%Y-%m-%d'), limit)
+        )
+        metrics.inc('geocoder_key_rotations_total')
+        logging.warning(f"API ключ {key_id} исчерпал квоту, переключаемся на следующий.")
+
+    def remaining(self):
+        """Остаток дневной квоты по всем ключам пула."""
+        used = self.used_today()
+        return sum(max(0, limit - used.get(key_id, 0)) for key_id, _, limit in self.keys)
+
+    @classmethod
+    def remaining_shared(cls):
+        """Остаток дневной квоты по всем пулам воркера; ключ из нескольких файлов считается один раз."""
+        remaining = {}
+        for pool in cls.pools.values():
+            used = pool.used_today()
+            for key_id, _, limit in pool.keys:
+                remaining[key_id] = max(remaining.get(key_id, 0), limit - used.get(key_id, 0))
+        return sum(remaining.values())
+
+    def close(self):
+        self.connection.close()
+
+
+class CheckpointStore:
+    """Промежуточные результаты обработки файлов в SQLite.
+
+    Для каждого файла (по хэшу загрузки) хранит координаты уже обработанных
+    строк, которые ещё не попали в сохранённый Excel, и индекс первой
+    необработанной строки, с которой продолжается следующий запуск.
+    """
+
+    shared = None
+
+    def __init__(self, db_path=CHECKPOINT_PATH):
+        self.connection = open_sqlite(db_path)
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS rows ('
+            'file_hash TEXT NOT NULL, row_index INTEGER NOT NULL, coordinates TEXT NOT NULL, '
+            'PRIMARY KEY (file_hash, row_index))'
+        )
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS progress (file_hash TEXT PRIMARY KEY, next_row INTEGER NOT NULL, updated REAL NOT NULL)'
+        )
+
+    @classmethod
+    def open(cls):
+        """Общее хранилище воркера, создаётся при первом обращении."""
+        if cls.shared is None:
+            cls.shared = cls()
+        return cls.shared
+
+    @classmethod
+    def close_shared(cls):
+        if cls.shared is not None:
+            cls.shared.close()
+            cls.shared = None
+
+    @staticmethod
+    def decode(value):
+        """(широта, долгота, точность) из JSON; старые записи - строка "широта, долгота"."""
+        if value.startswith('['):
+            return tuple(json.loads(value))
+        latitude, longitude = map(float, value.split(','))
+        return latitude, longitude, None
+
+    def load(self, file_hash):
+        """Сохранённые результаты {индекс строки: (широта, долгота, точность)} и индекс следующей строки."""
+        coordinates = {
+            index: self.decode(value) for index, value in self.connection.execute(
+                'SELECT row_index, coordinates FROM rows WHERE file_hash = ?', (file_hash,)
+            )
+        }
+        return coordinates, self.next_row(file_hash)
+
+    def load_rows(self, file_hash, start, end):
+        """Сохранённые результаты строк [start, end): потоковая обработка читает их по кускам."""
+        return {
+            index: self.decode(value) for index, value in self.connection.execute(
+                'SELECT row_index, coordinates FROM rows WHERE file_hash = ? AND row_index >= ? AND row_index < ?',
+                (file_hash, int(start), int(end))
+            )
+        }
+
+    def next_row(self, file_hash):
+        """Индекс строки, с которой продолжается обработка файла."""
+        row = self.connection.execute('SELECT next_row FROM progress WHERE file_hash = ?', (file_hash,)).fetchone()
+        return row[0] if row else 0
+
+    def save(self, file_hash, coordinates, next_row):
+        """Запись пачки результатов и позиции продолжения одной транзакцией."""
+        with self.connection:
+            self.connection.execute('BEGIN')
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO rows (file_hash, row_index, coordinates) VALUES (?, ?, ?)',
+                [(file_hash, int(index), json.dumps(list(value))) for index, value in coordinates.items()]
+            )
+            self.connection.execute(
+                'INSERT OR REPLACE INTO progress (file_hash, next_row, updated) VALUES (?, ?, ?)',
+                (file_hash, int(next_row), time.time())
+            )
+
+    def clear_rows(self, file_hash):
+        """Удаление координат, которые уже сохранены в самом Excel файле."""
+        self.connection.execute('DELETE FROM rows WHERE file_hash = ?', (file_hash,))
+
+    def close(self):
+        self.connection.close()
+
+
+class BaseSnapshots:
+    """Координаты строк последней обработанной версии каждой базы в SQLite.
+
+    База - файл, который загружают повторно в новых версиях (ключ по
+    умолчанию - см. default_base). Для каждой строки с координатами хранится отпечаток её
+    адреса (address_fingerprint): строки новой версии с тем же отпечатком
+    получают координаты без запроса к геокодеру. Потоковая обработка читает
+    снимок по кускам (lookup, known_points) и пишет новый через черновик
+    (stage, add, commit), не держа ни один из них в памяти.
+    """
+
+    shared = None
+    QUERY_BATCH = 500  # Отпечатков в одном IN (...): старые SQLite принимают не больше 999 параметров
+
+    def __init__(self, db_path=BASE_SNAPSHOT_PATH):
+        self.connection = open_sqlite(db_path)
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS snapshot_rows ('
+            'base TEXT NOT NULL, fingerprint TEXT NOT NULL, latitude REAL NOT NULL, longitude REAL NOT NULL, '
+            'precision TEXT, PRIMARY KEY (base, fingerprint))'
+        )
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS snapshots ('
+            'base TEXT PRIMARY KEY, file_hash TEXT NOT NULL, rows INTEGER NOT NULL, updated REAL NOT NULL)'
+        )
+        # Поиск строки прошлой версии по координатам: так узнаются изменённые адреса
+        self.connection.execute('CREATE INDEX IF NOT EXISTS snapshot_points ON snapshot_rows (base, latitude, longitude)')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS snapshot_drafts ('
+            'draft TEXT NOT NULL, fingerprint TEXT NOT NULL, latitude REAL NOT NULL, longitude REAL NOT NULL, '
+            'precision TEXT, PRIMARY KEY (draft, fingerprint))'
+        )
+
+    @classmethod
+    def open(cls):
+        """Общее хранилище воркера, создаётся при первом обращении."""
+        if cls.shared is None:
+            cls.shared = cls()
+        return cls.shared
+
+    @classmethod
+    def close_shared(cls):
+        if cls.shared is not None:
+            cls.shared.close()
+            cls.shared = None
+
+    @staticmethod
+    def default_base(file_path):
+        """Ключ базы для файла, если вызывающий его не задал.
+
+        Загрузки лежат в одном каталоге, и новая версия приходит под тем же
+        именем, поэтому для них ключ - имя файла. Для остальных файлов - полный
+        путь: одноимённые книги из разных каталогов не должны делить снимок.
+        """
+        path = os.path.realpath(file_path)
+        if os.path.dirname(path) == os.path.realpath(UPLOAD_FOLDER):
+            return os.path.basename(path)
+        return path
+
+    def load(self, base):
+        """Снимок базы {отпечаток: (широта, долгота, точность)}; пустой, если базу ещё не обрабатывали."""
+        return {
+            fingerprint: (latitude, longitude, precision) for fingerprint, latitude, longitude, precision in self.connection.execute(
+                'SELECT fingerprint, latitude, longitude, precision FROM snapshot_rows WHERE base = ?', (base,)
+            )
+        }
+
+    def lookup(self, base, fingerprints):
+        """Строки снимка базы с данными отпечатками: {отпечаток: (широта, долгота, точность)}."""
+        fingerprints = list(fingerprints)
+        found = {}
+        for start in range(0, len(fingerprints), self.QUERY_BATCH):
+            part = fingerprints[start:start + self.QUERY_BATCH]
+            found.update(
+                (fingerprint, (latitude, longitude, precision)) for fingerprint, latitude, longitude, precision in self.connection.execute(
+                    'SELECT fingerprint, latitude, longitude, precision FROM snapshot_rows '
+                    f'WHERE base = ? AND fingerprint IN ({", ".join("?" * len(part))})', (base, *part)
+                )
+            )
+        return found
+
+    def known_points(self, base, points):
+        """Те из точек (широта, долгота), что есть в снимке базы у какой-нибудь строки."""
+        return {
+            point for point in set(points) if self.connection.execute(
+                'SELECT 1 FROM snapshot_rows WHERE base = ? AND latitude = ? AND longitude = ? LIMIT 1', (base, *point)
+            ).fetchone()
+        }
+
+    def stage(self):
+        """Новый черновик снимка: пишется частями через add и заменяет снимок базы в commit."""
+        return uuid.uuid4().hex
+
+    def add(self, draft, snapshot):
+        """Дописывание строк {отпечаток: (широта, долгота, точность)} в черновик; повторный отпечаток заменяется."""
+        with self.connection:
+            self.connection.execute('BEGIN')
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO snapshot_drafts (draft, fingerprint, latitude, longitude, precision) VALUES (?, ?, ?, ?, ?)',
+                [(draft, fingerprint, *value) for fingerprint, value in snapshot.items()]
+            )
+
+    def commit(self, draft, base, file_hash):
+        """Замена снимка базы черновиком одной транзакцией."""
+        with self.connection:
+            self.connection.execute('BEGIN')
+            self.connection.execute('DELETE FROM snapshot_rows WHERE base = ?', (base,))
+            rows = self.connection.execute(
+                'INSERT INTO snapshot_rows (base, fingerprint, latitude, longitude, precision) '
+                'SELECT ?, fingerprint, latitude, longitude, precision FROM snapshot_drafts WHERE draft = ?', (base, draft)
+            ).rowcount
+            self.connection.execute('DELETE FROM snapshot_drafts WHERE draft = ?', (draft,))
+            self.connection.execute(
+                'INSERT OR REPLACE INTO snapshots (base, file_hash, rows, updated) VALUES (?, ?, ?, ?)',
+                (base, file_hash, rows, time.time())
+            )
+
+    def discard(self, draft):
+        """Удаление черновика прерванной обработки."""
+        self.connection.execute('DELETE FROM snapshot_drafts WHERE draft = ?', (draft,))
+
+    def replace(self, base, file_hash, snapshot):
+        """Замена снимка базы снимком текущей версии одной транзакцией."""
+        with self.connection:
+            self.connection.execute('BEGIN')
+            self.connection.execute('DELETE FROM snapshot_rows WHERE base = ?', (base,))
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO snapshot_rows (base, fingerprint, latitude, longitude, precision) VALUES (?, ?, ?, ?, ?)',
+                [(base, fingerprint, *value) for fingerprint, value in snapshot.items()]
+            )
+            self.connection.execute(
+                'INSERT OR REPLACE INTO snapshots (base, file_hash, rows, updated) VALUES (?, ?, ?, ?)',
+                (base, file_hash, len(snapshot), time.time())
+            )
+
+    def version(self, base):
+        """Хэш и число строк последней обработанной версии базы или None."""
+        row = self.connection.execute('SELECT file_hash, rows FROM snapshots WHERE base = ?', (base,)).fetchone()
+        return {'file_hash': row[0], 'rows': row[1]} if row else None
+
+    def close(self):
+        self.connection.close()
+
@@ -0,0 +1,66 @@
+"""Разбивка времени одного запроса по стадиям обработки.
+
+Включается клиентом для отдельного запроса: сервис создаёт Timing и делает
+его текущим, а стадии движка (чтение книги, выбор строк, геокодирование,
+запись) добавляют в него своё время. Без текущего Timing стадии ничего не
+записывают.
+"""
+import contextlib
+import contextvars
+import time
+
+current = contextvars.ContextVar('excel_geocoder_timing', default=None)
+
+
+class Timing:
+    """Суммарное время и число вызовов по стадиям.
+
+    Стадии на каждый адрес (cache, upstream) выполняются параллельно, поэтому
+    их время - сумма по всем вызовам и может превышать время запроса.
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.stages = {}  # Имя стадии -> [секунд, вызовов]
+
+    def add(self, name, seconds):
+        stage = self.stages.setdefault(name, [0.0, 0])
+        stage[0] += seconds
+        stage[1] += 1
+
+    def as_dict(self):
+        return {
+            'total_seconds': round(time.perf_counter() - self.started, 6),
+            'stages': {name: {'seconds': round(seconds, 6), 'count': count} for name, (seconds, count) in self.stages.items()},
+        }
+
+    def server_timing(self):
+        """Значение заголовка Server-Timing: длительности в миллисекундах, в desc - число вызовов."""
+        parts = [f'{name};dur={seconds * 1000:.1f};desc="{count}x"' for name, (seconds, count) in self.stages.items()]
+        parts.append(f'total;dur={(time.perf_counter() - self.started) * 1000:.1f}')
+        return ', '.join(parts)
+
+
+@contextlib.contextmanager
+def stage(name):
+    """Учёт времени блока в текущем Timing, если он есть."""
+    timing = current.get()
+    if timing is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timing.add(name, time.perf_counter() - start)
+
+
+async def bind(timing, awaitable):
+    """Выполнение awaitable с timing в качестве текущего.
+
+    Для задач, которые создаются вне контекста запроса (потоковые ответы):
+    asyncio.ensure_future(bind(timing, ...)) - значение ставится в копии
+    контекста задачи и не утекает наружу.
+    """
+    current.set(timing)
+    return await awaitable
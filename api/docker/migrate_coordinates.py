@@ -0,0 +1,52 @@
+"""Перенос строковой колонки "Координаты" в числовые Широта/Долгота.
+
+Для уже обработанных книг (например, api/excel_f/*.xlsx): строки
+"широта, долгота" разбираются векторно, результат пишется в колонки
+Широта/Долгота (float64) и Статус, строковая колонка остаётся как есть.
+
+Запуск: python migrate_coordinates.py ../excel_f/*.xlsx [--output-dir migrated]
+"""
+import argparse
+import asyncio
+import glob
+import os
+
+from excel_geocoder import executor
+from excel_geocoder.excel import ExcelHandler
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Перенос "Координаты" в Широта/Долгота')
+    parser.add_argument('paths', nargs='+', help='файлы или шаблоны xlsx')
+    parser.add_argument('--output-dir', help='куда писать результат; по умолчанию файлы перезаписываются')
+    return parser.parse_args()
+
+
+async def migrate(path, output_dir=None):
+    excel_handler = ExcelHandler(path)
+    await excel_handler.read_excel()
+    if 'Координаты' not in excel_handler.dataframe.columns:
+        print(f"{path}: колонки 'Координаты' нет, пропущен")
+        return
+    excel_handler.add_coordinates_column('Координаты')
+    migrated = excel_handler.migrate_coordinates('Координаты')
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+        excel_handler.file_path = os.path.join(output_dir, os.path.basename(path))
+    await excel_handler.save_excel()
+    print(f"{path}: перенесено строк {migrated} -> {excel_handler.file_path}")
+
+
+async def main():
+    args = parse_args()
+    paths = sorted({path for pattern in args.paths for path in glob.glob(pattern)})
+    for path in paths:
+        try:
+            await migrate(path, args.output_dir)
+        except Exception as e:
+            print(f"{path}: {e}")
+    executor.close_executor()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
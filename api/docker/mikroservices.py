@@ -1,10 +1,49 @@
-from quart import Quart, jsonify, request, send_file
+from quart import Quart, g, jsonify, request, send_file, stream_with_context
+from werkzeug.datastructures import ContentRange
+from werkzeug.exceptions import RequestEntityTooLarge, RequestedRangeNotSatisfiable
+from werkzeug.http import parse_options_header
+from werkzeug.sansio.multipart import Data, Epilogue, File, MultipartDecoder, NeedData
 import os
 import aiofiles
 import logging
-import pandas as pd
-import aiohttp
+import asyncio
+import cProfile
+import csv
+import hashlib
+import importlib
+import io
+import json
+import marshal
+import math
+import pstats
+import re
+import sqlite3
+import time
+import uuid
 import sys
+import unicodedata
+import zlib
+from datetime import datetime, timezone
+from urllib.parse import quote
+
+try:
+    import brotli  # Необязательная зависимость: без неё ответы сжимаются только gzip
+except ImportError:
+    brotli = None
+
+# Движок геокодирования и работа с Excel - в пакете excel_geocoder, здесь только HTTP.
+# pandas и openpyxl не импортируются при запуске воркера: тяжёлые имена берутся
+# через core.<имя> и загружаются при первом обращении
+import excel_geocoder as core
+from excel_geocoder import executor
+from excel_geocoder.config import (ADMIN_TOKEN, COMPRESS_BROTLI_QUALITY, COMPRESS_GZIP_LEVEL, COMPRESS_MIN_SIZE,
+                                   GEOCODER_CONCURRENCY, JOB_PROGRESS_INTERVAL, JOB_STORE_PATH, JOB_WORKERS, PROFILE_MAX_SECONDS, SPATIAL_MAX_RESULTS, SPATIAL_REVERSE_RADIUS, UPLOAD_CHUNK_SIZE, UPLOAD_FOLDER, UPLOAD_MAX_SIZE)
+from excel_geocoder.db import open_sqlite
+from excel_geocoder.engine import AddressGeocoder, close_geocoder, geocode_stream, open_geocoder
+from excel_geocoder.files import file_fingerprint, write_fingerprint
+from excel_geocoder.metrics import metrics
+from excel_geocoder.storage import BaseSnapshots, CheckpointStore, KeyPool
+from excel_geocoder.timing import Timing, bind as bind_timing, current as current_timing, stage
 
 
 sys.stdout.reconfigure(encoding='utf-8')
@@ -17,100 +56,539 @@ logging.basicConfig(level=logging.DEBUG)
 # Проверка на существование директории uploads
 os.makedirs('./uploads', exist_ok=True)
 
-class ExcelHandler:
-    def __init__(self, file_path):
-        self.file_path = file_path
-        self.dataframe = None
 
-    def read_excel(self):
-        """Чтение Excel файла и сохранение данных в dataframe."""
+app.config['MAX_CONTENT_LENGTH'] = UPLOAD_MAX_SIZE + 64 * 1024  # Запас на заголовки multipart
+
+
+STREAM_FIELDS = ('index', 'address', 'latitude', 'longitude', 'precision', 'status')
+STREAM_MIMETYPES = {'ndjson': 'application/x-ndjson', 'csv': 'text/csv'}
+TIMING_HEADER = 'X-Timing'  # "1" в заголовке или ?timing=1 включает разбивку времени для запроса
+XLSX_MIMETYPE = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+# Ответы, которые сжимаются по Accept-Encoding; xlsx уже zip и не сжимается
+COMPRESSIBLE_MIMETYPES = {'application/json', 'application/x-ndjson', 'text/csv', 'text/plain'}
+
+# Одновременно профилируется не больше одного окна на воркер
+profile_lock = asyncio.Lock()
+
+
+def format_stream_row(row, stream_format):
+    """Строка результата в формате потока: NDJSON или CSV."""
+    if stream_format == 'csv':
+        buffer = io.StringIO()
+        csv.writer(buffer).writerow([row.get(field) for field in STREAM_FIELDS])
+        return buffer.getvalue()
+    return json.dumps(row, ensure_ascii=False) + '\n'
+
+
+async def stream_file_results(file_path, geocoder, concurrency, resume, stream_format, streaming=None, timing=None,
+                              base=None, diff=True):
+    """Обработка файла с выдачей каждой строки сразу по готовности.
+
+    Последней строкой NDJSON идёт итог со ссылкой на готовый xlsx и, если
+    запрошена, разбивкой времени; в CSV итог не пишется, чтобы не ломать таблицу.
+    """
+    rows = asyncio.Queue()
+
+    def on_row(index, address, latitude, longitude, precision):
+        status = 'ok' if latitude is not None and longitude is not None else 'not_found'
+        rows.put_nowait({'index': int(index), 'address': address, 'latitude': latitude,
+                         'longitude': longitude, 'precision': precision, 'status': status})
+
+    task = asyncio.ensure_future(bind_timing(timing, core.geocode_file(
+        file_path, geocoder, concurrency, resume=resume, export=True, on_row=on_row, streaming=streaming, base=base, diff=diff
+    )))
+    task.add_done_callback(lambda _: rows.put_nowait(None))
+    try:
+        if stream_format == 'csv':
+            yield format_stream_row(dict(zip(STREAM_FIELDS, STREAM_FIELDS)), stream_format)
+        while True:
+            row = await rows.get()
+            if row is None:
+                break
+            yield format_stream_row(row, stream_format)
+        stats = await task
+        if stream_format == 'ndjson':
+            summary = {'done': True, **stats}
+            # /download отдаёт только загруженные файлы, для остальных ссылки нет
+            if upload_path(file_path) is not None:
+                summary['download_url'] = f'/download?file_path={quote(file_path)}'
+            if timing is not None:
+                summary['timing'] = timing.as_dict()
+            yield format_stream_row(summary, stream_format)
+    finally:
+        task.cancel()
+
+
+def upload_filename(filename):
+    """Безопасное имя загружаемого файла или None, если от имени ничего не осталось.
+
+    Правила те же, что у werkzeug.utils.secure_filename (разделители путей и
+    пробелы - в '_', остальное, кроме букв, цифр, '.', '-' и '_', отбрасывается,
+    точки по краям срезаются), но буквы не ограничены ASCII: secure_filename
+    превращает 'база.xlsx' в 'xlsx'.
+    """
+    filename = unicodedata.normalize('NFKC', filename or '')
+    for separator in ('/', '\\'):
+        filename = filename.replace(separator, ' ')
+    filename = re.sub(r'[^\w.-]', '', '_'.join(filename.split())).strip('._')
+    return filename or None
+
+
+def upload_path(file_path):
+    """Полный путь к книге xlsx внутри UPLOAD_FOLDER или None.
+
+    Путь из запроса разворачивается (.., символические ссылки), и всё, что
+    оказывается вне каталога загрузок, отклоняется.
+    """
+    if not file_path:
+        return None
+    root = os.path.realpath(UPLOAD_FOLDER)
+    path = os.path.realpath(file_path)
+    if os.path.commonpath([root, path]) != root or not path.lower().endswith('.xlsx') or not os.path.isfile(path):
+        return None
+    return path
+
+
+def file_validators(file_path):
+    """ETag и Last-Modified файла по размеру и времени изменения.
+
+    Книга перезаписывается только когда в ней что-то поменялось (см.
+    geocode_file), поэтому значения держатся, пока содержимое то же, и
+    одинаковы во всех воркерах.
+    """
+    stat = os.stat(file_path)
+    return f'{stat.st_size:x}-{stat.st_mtime_ns:x}', datetime.fromtimestamp(int(stat.st_mtime), timezone.utc)
+
+
+def is_not_modified(etag, last_modified):
+    """Актуальна ли копия клиента: по If-None-Match, а без него - по If-Modified-Since."""
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+    if request.if_modified_since is not None:
+        return last_modified <= request.if_modified_since
+    return False
+
+
+def range_applies(etag, last_modified):
+    """Отдавать ли кусок по Range: один диапазон и файл не менялся с версии из If-Range.
+
+    Если файл изменился, докачивать нечего - отдаётся весь файл.
+    """
+    if request.range is None or len(request.range.ranges) != 1:
+        return False
+    if_range = request.if_range
+    if if_range.etag is not None:
+        return if_range.etag == etag
+    if if_range.date is not None:
+        return last_modified <= if_range.date
+    return True
+
+
+async def send_workbook(file_path, conditional=True):
+    """Отдача обработанного xlsx с ETag и Last-Modified.
+
+    При conditional (GET скачивания) клиент, у которого уже есть эта версия
+    файла (If-None-Match или If-Modified-Since), получает 304 без тела, а запрос
+    с Range - 206 с нужным куском. Ответ на POST всегда содержит файл целиком:
+    304 и 206 для него не определены. Копию файла клиент хранит, но перед
+    использованием сверяет с сервером: обработка, которая что-то изменила в
+    книге, меняет и её ETag.
+    """
+    etag, last_modified = file_validators(file_path)
+    if conditional and is_not_modified(etag, last_modified):
+        response = app.response_class('', status=304)
+    else:
         try:
-            self.dataframe = pd.read_excel(self.file_path)
-            logging.info("Excel файл успешно прочитан.")
-        except FileNotFoundError:
-            raise Exception(f"Файл {self.file_path} не найден.")
-        except Exception as e:
-            raise Exception(f"Ошибка при чтении файла: {str(e)}")
-    
-    def add_coordinates_column(self, coordinates_column_name='Координаты'):
-        """Добавление новой колонки с координатами, если её ещё нет."""
-        if self.dataframe is not None:
-            if coordinates_column_name not in self.dataframe.columns:
-                self.dataframe[coordinates_column_name] = None
-                logging.info(f"Колонка '{coordinates_column_name}' добавлена.")
-            else:
-                logging.info(f"Колонка '{coordinates_column_name}' уже существует.")
+            response = await send_file(file_path, as_attachment=True, attachment_filename='updated_addresses.xlsx',
+                                       mimetype=XLSX_MIMETYPE, add_etags=False, cache_timeout=0,
+                                       last_modified=last_modified,
+                                       conditional=conditional and range_applies(etag, last_modified))
+            if response.status_code == 206:
+                # Quart 0.17 пишет в Content-Range конец куска на байт меньше, чем отдаёт
+                body = response.response
+                response.content_range = ContentRange('bytes', body.begin, body.end, body.size)
+        except RequestedRangeNotSatisfiable:
+            response = app.response_class('', status=416)
+            response.content_range = ContentRange('bytes', None, None, os.path.getsize(file_path))
+        if conditional:
+            response.accept_ranges = 'bytes'
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    response.cache_control.public = False
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+
+class StreamCompressor:
+    """Сжатие gzip или br по кускам.
+
+    Каждый кусок сжимается со сбросом буфера компрессора, поэтому строки
+    потокового ответа доходят до клиента сразу, а не копятся в компрессоре.
+    """
+
+    def __init__(self, encoding):
+        self.encoding = encoding
+        if encoding == 'br':
+            self.compressor = brotli.Compressor(quality=COMPRESS_BROTLI_QUALITY)
         else:
-            raise Exception("Dataframe не загружен. Сначала вызовите метод read_excel.")
-    
-    async def save_excel(self):
-        """Асинхронное сохранение Excel файла с изменениями."""
-        try:
-            self.dataframe.to_excel(self.file_path, index=False)
-            logging.info(f"Файл успешно сохранен: {self.file_path}")
-        except Exception as e:
-            raise Exception(f"Ошибка при сохранении Excel файла: {str(e)}")
+            self.compressor = zlib.compressobj(COMPRESS_GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)  # Заголовок gzip
 
+    def compress(self, data):
+        if self.encoding == 'br':
+            return self.compressor.process(data) + self.compressor.flush()
+        return self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
 
-class AddressGeocoder:
-    def __init__(self, api_key_file):
-        self.api_key = self.get_api_key(api_key_file)
+    def finish(self):
+        if self.encoding == 'br':
+            return self.compressor.finish()
+        return self.compressor.flush()
+
+
+def response_encoding():
+    """Сжатие, которое принимает клиент: br (если установлен brotli) или gzip; None - без сжатия."""
+    encodings = request.accept_encodings
+    br = encodings['br'] if brotli is not None else 0
+    if br and br >= encodings['gzip']:
+        return 'br'
+    if encodings['gzip']:
+        return 'gzip'
+    return None
+
+
+async def compress_chunks(body, encoding, charset):
+    """Сжатые куски тела потокового ответа."""
+    compressor = StreamCompressor(encoding)
+    async with body:
+        async for chunk in body:
+            data = compressor.compress(chunk.encode(charset) if isinstance(chunk, str) else chunk)
+            if data:
+                yield data
+    yield compressor.finish()
+
+
+async def ndjson_addresses(body):
+    """Адреса из NDJSON тела запроса по мере поступления строк.
+
+    Строка - JSON строка с адресом или объект с полем address.
+    """
+    buffer = b''
+    async for chunk in body:
+        buffer += chunk
+        *lines, buffer = buffer.split(b'\n')
+        for line in lines:
+            if line.strip():
+                item = json.loads(line)
+                yield item.get('address') if isinstance(item, dict) else item
+    if buffer.strip():
+        item = json.loads(buffer)
+        yield item.get('address') if isinstance(item, dict) else item
+
+
+async def iterate(items):
+    """Асинхронный итератор по обычному списку."""
+    for item in items:
+        yield item
+
+
+class JobStore:
+    """Статусы фоновых задач /process в SQLite, видимые всем воркерам."""
+
+    FIELDS = ('status', 'rows_total', 'rows_done', 'errors', 'error')
+
+    def __init__(self, db_path=JOB_STORE_PATH):
+        self.connection = open_sqlite(db_path)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS jobs ('
+            'id TEXT PRIMARY KEY, status TEXT NOT NULL, file_path TEXT NOT NULL, '
+            'rows_total INTEGER NOT NULL DEFAULT 0, rows_done INTEGER NOT NULL DEFAULT 0, '
+            'errors INTEGER NOT NULL DEFAULT 0, error TEXT, created REAL NOT NULL, updated REAL NOT NULL)'
+        )
+
+    def create(self, file_path):
+        """Регистрация новой задачи в статусе queued, возвращает её ID."""
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        self.connection.execute(
+            'INSERT INTO jobs (id, status, file_path, created, updated) VALUES (?, ?, ?, ?, ?)',
+            (job_id, 'queued', file_path, now, now)
+        )
+        return job_id
+
+    def update(self, job_id, **fields):
+        """Обновление статуса и прогресса задачи."""
+        columns = [name for name in fields if name in self.FIELDS]
+        assignments = ''.join(f'{name} = ?, ' for name in columns)
+        self.connection.execute(
+            f'UPDATE jobs SET {assignments}updated = ? WHERE id = ?',
+            [fields[name] for name in columns] + [time.time(), job_id]
+        )
+
+    def get(self, job_id):
+        """Задача в виде словаря или None, если такой нет."""
+        row = self.connection.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        return dict(row) if row is not None else None
+
+    def close(self):
+        self.connection.close()
+
+
+class JobQueue:
+    """Фоновое выполнение /process в пуле задач воркера."""
+
+    store = None
+    semaphore = None
+    tasks = set()
+
+    @classmethod
+    def open(cls):
+        """Открытие хранилища задач и пула воркера."""
+        if cls.store is None:
+            cls.store = JobStore()
+            cls.semaphore = asyncio.Semaphore(JOB_WORKERS)
+        return cls.store
+
+    @classmethod
+    async def close(cls):
+        """Отмена незавершённых задач и закрытие хранилища."""
+        for task in list(cls.tasks):
+            task.cancel()
+        await asyncio.gather(*cls.tasks, return_exceptions=True)
+        if cls.store is not None:
+            cls.store.close()
+            cls.store = None
+
+    @classmethod
+    def submit(cls, file_path, geocoder, concurrency=GEOCODER_CONCURRENCY, resume=True, streaming=None, base=None, diff=True):
+        """Постановка файла в очередь, возвращает ID задачи."""
+        job_id = cls.open().create(file_path)
+        # Задача живёт дольше запроса: его разбивка времени ей не передаётся
+        task = asyncio.create_task(bind_timing(None, cls.run(job_id, file_path, geocoder, concurrency, resume, streaming,
+                                                            base, diff)))
+        cls.tasks.add(task)
+        task.add_done_callback(cls.tasks.discard)
+        return job_id
+
+    @classmethod
+    async def run(cls, job_id, file_path, geocoder, concurrency, resume=True, streaming=None, base=None, diff=True):
+        """Выполнение задачи с записью прогресса в хранилище."""
+        async with cls.semaphore:
+            cls.store.update(job_id, status='running')
+            last_update = 0
+
+            def progress(rows_done, rows_total, errors):
+                nonlocal last_update
+                # Пишем прогресс не чаще JOB_PROGRESS_INTERVAL, чтобы не нагружать SQLite
+                if time.monotonic() - last_update >= JOB_PROGRESS_INTERVAL or rows_done == rows_total:
+                    cls.store.update(job_id, rows_done=rows_done, rows_total=rows_total, errors=errors)
+                    last_update = time.monotonic()
 
-    def get_api_key(self, file_path):
-        """Чтение API ключа из файла."""
-        try:
-            with open(file_path, 'r', encoding='utf-8') as file:
-                api_key = file.read().strip()
-            return api_key
-        except FileNotFoundError:
-            raise Exception(f"Файл {file_path} не найден.")
-        except Exception as e:
-            raise Exception(f"Ошибка чтения API ключа: {str(e)}")
-
-    async def get_coordinates(self, address):
-        """Получение координат по адресу с использованием Yandex Geocoder API."""
-        url = 'https://geocode-maps.yandex.ru/1.x/'
-        params = {
-            'geocode': address,
-            'format': 'json',
-            'apikey': self.api_key
-        }
-
-        async with aiohttp.ClientSession() as session:
             try:
-                async with session.get(url, params=params) as response:
-                    response.raise_for_status()  # Проверяем, что запрос успешен
-                    data = await response.json()
-
-                    if 'response' in data and data['response']['GeoObjectCollection']['featureMember']:
-                        pos = data['response']['GeoObjectCollection']['featureMember'][0]['GeoObject']['Point']['pos']
-                        lon, lat = map(float, pos.split())  # Долгота, широта
-                        return lat, lon
-                    else:
-                        logging.warning(f"Координаты не найдены для адреса: {address}")
-                        return None, None
-            except aiohttp.ClientError as e:
-                logging.error(f"Ошибка при запросе к API для адреса {address}: {str(e)}")
-                return None, None
-
-            
+                stats = await core.geocode_file(file_path, geocoder, concurrency, progress=progress, resume=resume,
+                                                streaming=streaming, base=base, diff=diff)
+                cls.store.update(job_id, status='done', rows_done=stats['rows'], rows_total=stats['rows'], errors=stats['errors'])
+            except asyncio.CancelledError:
+                cls.store.update(job_id, status='failed', error='Задача прервана остановкой сервера')
+                raise
+            except Exception as e:
+                logging.error(f"Ошибка в задаче {job_id}: {str(e)}")
+                cls.store.update(job_id, status='failed', error=str(e))
+
+
+class UploadTooLarge(Exception):
+    pass
+
+
+class UploadIncomplete(Exception):
+    pass
+
+
+class UploadBadFilename(Exception):
+    pass
+
+
+async def stream_upload(body, boundary, field_name='file', directory=UPLOAD_FOLDER):
+    """Потоковый разбор multipart тела и запись файла на диск блоками.
+
+    В памяти держится не больше UPLOAD_CHUNK_SIZE байт файла; SHA-256
+    считается на лету. Файл сначала пишется во временный .part и
+    переименовывается только после успешного приёма целиком: тело, оборванное
+    до закрывающей границы multipart, отклоняется, как и файл без пригодного
+    имени (см. upload_filename) - до создания .part. Если под тем же
+    именем уже лежит файл с таким же хэшем, новая копия отбрасывается, чтобы
+    не затереть уже обработанные координаты. Возвращает словарь с путём,
+    размером, хэшем и признаком повторной загрузки, или None, если поля нет.
+    """
+    decoder = MultipartDecoder(boundary.encode())
+    digest = hashlib.sha256()
+    buffer = bytearray()
+    size = 0
+    output = None
+    temp_path = file_path = None
+    done = False
+
+    try:
+        async for chunk in body:
+            decoder.receive_data(chunk)
+            event = decoder.next_event()
+            while not isinstance(event, (NeedData, Epilogue)):
+                if isinstance(event, File) and event.name == field_name and file_path is None:
+                    filename = upload_filename(event.filename)
+                    if filename is None:
+                        raise UploadBadFilename("File name is empty or contains no allowed characters")
+                    file_path = os.path.join(directory, filename)
+                    temp_path = f"{file_path}.{uuid.uuid4().hex}.part"
+                    output = await aiofiles.open(temp_path, 'wb')
+                elif isinstance(event, Data) and output is not None and not done:
+                    size += len(event.data)
+                    if size > UPLOAD_MAX_SIZE:
+                        raise UploadTooLarge(f"File is larger than {UPLOAD_MAX_SIZE} bytes")
+                    digest.update(event.data)
+                    buffer += event.data
+                    if len(buffer) >= UPLOAD_CHUNK_SIZE or not event.more_data:
+                        await output.write(bytes(buffer))
+                        buffer.clear()
+                    done = not event.more_data
+                event = decoder.next_event()
+        decoder.receive_data(None)
+
+        if output is None:
+            return None
+        if not done:
+            raise UploadIncomplete("Upload is incomplete: closing multipart boundary not received")
+        await output.close()
+        output = None
+
+        sha256 = digest.hexdigest()
+        duplicate = os.path.exists(file_path) and await file_fingerprint(file_path) == sha256
+        if duplicate:
+            os.remove(temp_path)
+            logging.info(f"Повторная загрузка того же файла, оставлена существующая копия: {file_path}")
+        else:
+            os.replace(temp_path, file_path)
+            write_fingerprint(file_path, sha256)
+        temp_path = None
+        return {'file_path': file_path, 'size': size, 'sha256': sha256, 'duplicate': duplicate}
+    finally:
+        if output is not None:
+            await output.close()
+        if temp_path is not None and os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+@app.before_serving
+async def startup():
+    """Открытие общих ресурсов воркера: геокодера, пула Excel, очереди задач."""
+    await open_geocoder()
+    executor.open_executor()
+    JobQueue.open()
+    app.metrics_flusher = asyncio.ensure_future(metrics.run_flusher())
+    # pandas и openpyxl нужны только обработке книг: модуль импортируется в фоновом
+    # потоке, и воркер принимает запросы, не дожидаясь этого
+    app.excel_preload = asyncio.get_running_loop().run_in_executor(None, importlib.import_module, 'excel_geocoder.excel')
+
+
+@app.after_serving
+async def shutdown():
+    """Закрытие общих ресурсов воркера."""
+    await close_geocoder()
+    await JobQueue.close()
+    CheckpointStore.close_shared()
+    BaseSnapshots.close_shared()
+    app.metrics_flusher.cancel()
+    metrics.close()
+    executor.close_executor()
+
+@app.before_request
+async def count_request_start():
+    metrics.add('http_requests_in_flight', 1)
+    g.in_flight = True
+
+
+@app.after_request
+async def compress_response(response):
+    """Сжатие JSON, NDJSON и CSV ответов по Accept-Encoding клиента.
+
+    Потоковые ответы сжимаются по мере выдачи строк, остальные - целиком,
+    если тело не меньше COMPRESS_MIN_SIZE. Обработчики after_request
+    вызываются в обратном порядке, поэтому этот стоит раньше add_timing и
+    сжимает уже окончательное тело.
+    """
+    if (response.mimetype not in COMPRESSIBLE_MIMETYPES or response.status_code in (204, 206, 304)
+            or 'Content-Encoding' in response.headers or request.method == 'HEAD'):
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = response_encoding()
+    if encoding is None:
+        return response
+    if isinstance(response.response, response.iterable_body_class):
+        response.response = response.iterable_body_class(compress_chunks(response.response, encoding, response.charset))
+        response.content_length = None
+    else:
+        data = await response.get_data()
+        if len(data) < COMPRESS_MIN_SIZE:
+            return response
+        compressor = StreamCompressor(encoding)
+        response.set_data(compressor.compress(data) + compressor.finish())
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+
+@app.before_request
+async def start_timing():
+    """Разбивка времени по стадиям - только если клиент её запросил."""
+    if request.headers.get(TIMING_HEADER) == '1' or request.args.get('timing') == '1':
+        g.timing = Timing()
+        current_timing.set(g.timing)
+
+
+@app.after_request
+async def add_timing(response):
+    """Server-Timing в заголовке и поле timing в JSON ответе."""
+    timing = g.get('timing')
+    if timing is None:
+        return response
+    response.headers['Server-Timing'] = timing.server_timing()
+    if response.is_json:
+        data = await response.get_json()
+        if isinstance(data, dict):
+            data['timing'] = timing.as_dict()
+            response.set_data(json.dumps(data, ensure_ascii=False))
+    return response
+
+
+@app.teardown_request
+async def count_request_end(exception=None):
+    # stream_with_context выполняет teardown ещё раз для копии контекста запроса:
+    # запрос вычитается только однажды
+    if g.pop('in_flight', False):
+        metrics.add('http_requests_in_flight', -1)
+
 @app.route('/upload', methods=['POST'])
 async def upload_file():
     try:
-        form = await request.files
-        if 'file' not in form:
+        mimetype, options = parse_options_header(request.headers.get('Content-Type', ''))
+        if mimetype != 'multipart/form-data' or 'boundary' not in options:
+            return jsonify({'error': 'Expected multipart/form-data'}), 400
+
+        # Тело читается и пишется на диск по частям, без буферизации всего файла
+        with stage('upload'):
+            upload = await stream_upload(request.body, options['boundary'])
+        if upload is None:
             return jsonify({'error': 'No file provided'}), 400
-        
-        file = form['file']
-        file_path = os.path.join('./uploads', file.filename)
-        content = file.read()
 
-        # Асинхронное сохранение файла
-        async with aiofiles.open(file_path, 'wb') as f:
-            await f.write(content)
+        # Прошлая обработанная версия той же базы: /process возьмёт из неё координаты неизменённых строк
+        base = BaseSnapshots.default_base(upload['file_path'])
+        return jsonify({'message': 'File uploaded successfully', **upload, 'base': base,
+                        'previous_version': BaseSnapshots.open().version(base)})
 
-        return jsonify({'message': 'File uploaded successfully', 'file_path': file_path})
-    
+    except UploadTooLarge as e:
+        return jsonify({'error': str(e)}), 413
+    except RequestEntityTooLarge:
+        return jsonify({'error': f"Request body is larger than {app.config['MAX_CONTENT_LENGTH']} bytes"}), 413
+    except (UploadIncomplete, UploadBadFilename) as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         logging.error(f"Ошибка загрузки файла: {e}")
         return jsonify({'error': str(e)}), 500
@@ -125,51 +603,260 @@ async def process_addresses():
         if not file_path or not os.path.exists(file_path):
             return jsonify({'error': 'Invalid or missing file path'}), 400
 
-        excel_handler = ExcelHandler(file_path)
         geocoder = AddressGeocoder(api_key_file)
+        concurrency = int(data.get('concurrency', GEOCODER_CONCURRENCY))  # Запросов "в полёте" одновременно
 
-        # Чтение Excel файла
-        excel_handler.read_excel()
-        excel_handler.add_coordinates_column('Координаты')  # Указываем имя колонки
-
-        request_count = 0
-        max_requests = 50  # Ограничение на количество запросов за один цикл
+        # Потоковый режим: строки уходят клиенту по мере готовности
+        stream_format = data.get('stream')
+        if stream_format is not None:
+            if stream_format not in STREAM_MIMETYPES:
+                return jsonify({'error': f"Unknown stream format: {stream_format}"}), 400
 
-        for index, row in excel_handler.dataframe.iterrows():
-            if request_count >= max_requests:
-                logging.info(f"Достигнуто максимальное количество запросов ({max_requests}). Сохранение файла.")
-                break  # Останавливаем цикл после 50 запросов
+            timing = g.get('timing')
 
-            address = row.get('Адрес')
-            if pd.isna(address):
-                continue
+            @stream_with_context
+            async def generate():
+                try:
+                    async for chunk in stream_file_results(file_path, geocoder, concurrency, data.get('resume', True), stream_format,
+                                                           data.get('streaming'), timing, data.get('base'),
+                                                           data.get('diff', True)):
+                        yield chunk
+                except Exception as e:
+                    logging.error(f"Ошибка во время обработки адресов: {str(e)}")
+                    if stream_format == 'ndjson':
+                        yield format_stream_row({'error': str(e)}, stream_format)
 
-            # Пропускаем, если координаты уже существуют
-            if pd.notna(excel_handler.dataframe.at[index, 'Координаты']):
-                continue
+            return generate(), 200, {'Content-Type': f'{STREAM_MIMETYPES[stream_format]}; charset=utf-8'}
 
-            # Получение координат
-            latitude, longitude = await geocoder.get_coordinates(address)
-            if latitude is not None and longitude is not None:
-                excel_handler.dataframe.at[index, 'Координаты'] = f"{latitude}, {longitude}"
+        # Режим фоновой задачи: сразу отдаём ID, прогресс - через /jobs/<id>
+        if data.get('job'):
+            job_id = JobQueue.submit(file_path, geocoder, concurrency, data.get('resume', True), data.get('streaming'),
+                                     data.get('base'), data.get('diff', True))
+            return jsonify({'job_id': job_id, 'status_url': f'/jobs/{job_id}'}), 202
 
-            request_count += 1
+        await core.geocode_file(file_path, geocoder, concurrency, resume=data.get('resume', True), export=True,
+                                streaming=data.get('streaming'), base=data.get('base'), diff=data.get('diff', True))
 
-        # Сохранение Excel файла после 50 запросов
-        await excel_handler.save_excel()
-        logging.info(f"Обработка завершена. Обработано запросов: {request_count}")
-
-        # Возврат файла пользователю через send_file
-        return await send_file(
-            file_path, 
-            as_attachment=True, 
-            attachment_filename='updated_addresses.xlsx', 
-            mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
-        )
+        # Возврат файла пользователю целиком; ETag из ответа годится для условного GET /download
+        return await send_workbook(file_path, conditional=False)
     
     except Exception as e:
         logging.error(f"Ошибка во время обработки адресов: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
+@app.route('/geocode/batch', methods=['POST'])
+async def geocode_batch():
+    """Геокодирование списка адресов без Excel: ответ - NDJSON по мере готовности.
+
+    Тело - JSON ({"addresses": [...], "apikey": ...} или просто список) либо
+    NDJSON поток адресов (application/x-ndjson, ключ в ?apikey=).
+    """
+    try:
+        concurrency = int(request.args.get('concurrency', GEOCODER_CONCURRENCY))
+        if request.mimetype == 'application/x-ndjson':
+            api_key_file = request.args.get('apikey')
+            addresses = ndjson_addresses(request.body)
+        else:
+            data = await request.get_json()
+            if isinstance(data, dict):
+                api_key_file = data.get('apikey', request.args.get('apikey'))
+                concurrency = int(data.get('concurrency', concurrency))
+                data = data.get('addresses')
+            else:
+                api_key_file = request.args.get('apikey')
+            if not isinstance(data, list):
+                return jsonify({'error': 'Expected a list of addresses'}), 400
+            addresses = iterate(data)
+
+        geocoder = AddressGeocoder(api_key_file)
+    except Exception as e:
+        logging.error(f"Ошибка во время пакетного геокодирования: {str(e)}")
+        return jsonify({'error': str(e)}), 400
+
+    timing = g.get('timing')
+
+    @stream_with_context
+    async def generate():
+        try:
+            async for result in geocode_stream(addresses, geocoder, concurrency):
+                yield json.dumps(result, ensure_ascii=False) + '\n'
+            if timing is not None:
+                yield json.dumps({'timing': timing.as_dict()}, ensure_ascii=False) + '\n'
+        except Exception as e:
+            # Статус уже отправлен, поэтому ошибка передаётся последней строкой
+            logging.error(f"Ошибка во время пакетного геокодирования: {str(e)}")
+            yield json.dumps({'error': str(e)}, ensure_ascii=False) + '\n'
+
+    return generate(), 200, {'Content-Type': 'application/x-ndjson; charset=utf-8'}
+
+@app.route('/download', methods=['GET'])
+async def download_file():
+    """Скачивание обработанного файла; только из каталога загрузок."""
+    file_path = upload_path(request.args.get('file_path'))
+    if file_path is None:
+        return jsonify({'error': 'File not found'}), 404
+    await core.export_file(file_path)
+    return await send_workbook(file_path)
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+async def job_status(job_id):
+    """Прогресс фоновой задачи и ссылка на файл после завершения."""
+    job = JobQueue.open().get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    job['rows_remaining'] = job['rows_total'] - job['rows_done']
+    if job['status'] == 'done':
+        job['download_url'] = f'/jobs/{job_id}/download'
+    return jsonify(job)
+
+@app.route('/jobs/<job_id>/download', methods=['GET'])
+async def job_download(job_id):
+    """Скачивание файла завершённой задачи."""
+    job = JobQueue.open().get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    if job['status'] != 'done':
+        return jsonify({'error': f"Job is {job['status']}"}), 409
+    await core.export_file(job['file_path'])
+    return await send_workbook(job['file_path'])
+
+@app.route('/cache/stats', methods=['GET'])
+async def cache_stats():
+    """Статистика кэша координат текущего воркера."""
+    if AddressGeocoder.cache is None:
+        return jsonify({'error': 'Cache is not initialized'}), 503
+    return jsonify(AddressGeocoder.cache.stats())
+
+async def spatial_index():
+    """Индекс воркера: строится при первом запросе, а не при запуске."""
+    if core.SpatialIndex.shared is None:
+        await core.SpatialIndex.load_shared()
+    return core.SpatialIndex.shared
+
+LATITUDE_ARGS = ('lat', 'south', 'north')  # Остальные координатные параметры - долготы
+
+
+def float_args(*names):
+    """Обязательные координаты из запроса: конечные числа, широты в [-90, 90], долготы в [-180, 180]."""
+    try:
+        values = [float(request.args[name]) for name in names]
+    except KeyError as e:
+        raise ValueError(f"Missing parameter: {e.args[0]}")
+    except ValueError:
+        raise ValueError(f"Parameters {', '.join(names)} must be numbers")
+    for name, value in zip(names, values):
+        limit = 90 if name in LATITUDE_ARGS else 180
+        if not math.isfinite(value) or abs(value) > limit:
+            raise ValueError(f"Parameter {name} must be between -{limit} and {limit}")
+    return values
+
+def count_arg(name, default):
+    """Число точек в ответе из запроса: целое от 1 до SPATIAL_MAX_RESULTS."""
+    try:
+        value = int(request.args.get(name, default))
+    except ValueError:
+        raise ValueError(f"Parameter {name} must be an integer")
+    if not 1 <= value <= SPATIAL_MAX_RESULTS:
+        raise ValueError(f"Parameter {name} must be between 1 and {SPATIAL_MAX_RESULTS}")
+    return value
+
+def is_admin():
+    """Запрос несёт верный X-Admin-Token; без ADMIN_TOKEN административные эндпоинты выключены."""
+    return bool(ADMIN_TOKEN) and request.headers.get('X-Admin-Token') == ADMIN_TOKEN
+
+@app.route('/spatial/reverse', methods=['GET'])
+async def spatial_reverse():
+    """Обратное геокодирование по уже найденным координатам."""
+    try:
+        latitude, longitude = float_args('lat', 'lon')
+        radius = float(request.args.get('radius_km', SPATIAL_REVERSE_RADIUS))
+        if not math.isfinite(radius) or radius < 0:
+            raise ValueError("Parameter radius_km must be a non-negative number")
+        result = (await spatial_index()).reverse(latitude, longitude, radius)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    if result is None:
+        return jsonify({'error': 'No known address within radius'}), 404
+    return jsonify(result)
+
+@app.route('/spatial/nearest', methods=['GET'])
+async def spatial_nearest():
+    """Ближайшие n известных точек."""
+    try:
+        latitude, longitude = float_args('lat', 'lon')
+        index = await spatial_index()
+        found = index.nearest(latitude, longitude, count_arg('n', 5))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify({'results': [index.point(position, distance) for position, distance in found]})
+
+@app.route('/spatial/bbox', methods=['GET'])
+async def spatial_bbox():
+    """Известные точки в прямоугольнике south/west/north/east."""
+    try:
+        south, west, north, east = float_args('south', 'west', 'north', 'east')
+        limit = count_arg('limit', SPATIAL_MAX_RESULTS)
+        results = (await spatial_index()).bbox(south, west, north, east, limit)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify({'results': results})
+
+@app.route('/spatial/reload', methods=['POST'])
+async def spatial_reload():
+    """Перестроение индекса, например после обработки новых файлов; только с X-Admin-Token."""
+    if not is_admin():
+        return jsonify({'error': 'Forbidden'}), 403
+    index = await core.SpatialIndex.load_shared()
+    return jsonify({'points': len(index), 'cells': len(index.cells)})
+
+@app.route('/admin/profile', methods=['POST'])
+async def admin_profile():
+    """Профиль воркера за ?seconds= секунд через cProfile.
+
+    Профилируется всё, что выполняет event loop воркера за это время, в том
+    числе чужие запросы. Ответ - сводка pstats (?sort=, ?limit=), а с
+    ?format=pstats - файл статистики для pstats/snakeviz.
+    """
+    if not is_admin():
+        return jsonify({'error': 'Forbidden'}), 403
+    try:
+        seconds = float(request.args.get('seconds', 10))
+        limit = int(request.args.get('limit', 40))
+    except ValueError:
+        return jsonify({'error': 'Parameters seconds and limit must be numbers'}), 400
+    if not 0 < seconds <= PROFILE_MAX_SECONDS:
+        return jsonify({'error': f"seconds must be in (0, {PROFILE_MAX_SECONDS:g}]"}), 400
+    sort = request.args.get('sort', 'cumulative')
+    if sort not in pstats.Stats.sort_arg_dict_default:
+        return jsonify({'error': f"Unknown sort key: {sort}"}), 400
+    if profile_lock.locked():
+        return jsonify({'error': 'Profiling is already running'}), 409
+
+    async with profile_lock:
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            profiler.disable()
+    logging.info(f"Профиль воркера {os.getpid()} снят за {seconds:g} с.")
+
+    headers = {'X-Worker-Pid': str(os.getpid())}
+    if request.args.get('format') == 'pstats':
+        stats = pstats.Stats(profiler)
+        headers['Content-Disposition'] = f'attachment; filename=profile-{os.getpid()}.pstats'
+        return marshal.dumps(stats.stats), 200, {**headers, 'Content-Type': 'application/octet-stream'}
+    output = io.StringIO()
+    pstats.Stats(profiler, stream=output).sort_stats(sort).print_stats(limit)
+    return output.getvalue(), 200, {**headers, 'Content-Type': 'text/plain; charset=utf-8'}
+
+@app.route('/metrics', methods=['GET'])
+async def metrics_endpoint():
+    """Метрики всех воркеров в текстовом формате Prometheus."""
+    extra_gauges = {}
+    if KeyPool.pools:
+        extra_gauges['geocoder_quota_remaining'] = KeyPool.remaining_shared()
+    return metrics.render(extra_gauges), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
 if __name__ == '__main__':
     app.run(port=5000)
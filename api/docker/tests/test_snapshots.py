@@ -0,0 +1,106 @@
+"""Сравнение новой версии базы с прошлой: pandas и потоковый путь geocode_file.
+
+Запуск из api/docker: python -m unittest discover tests
+"""
+import asyncio
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import pandas as pd
+
+from excel_geocoder import AddressGeocoder, BaseSnapshots, CheckpointStore, address_fingerprint
+from excel_geocoder.excel import geocode_file
+
+FOUND = (9.0, 9.0, 'exact')  # Ответ геокодера на любой адрес
+
+
+class StubGeocoder(AddressGeocoder):
+    """Геокодер без сети: запоминает запрошенные адреса и всегда находит FOUND."""
+
+    def __init__(self):
+        super().__init__(None, providers=['gazetteer'])
+        self.requested = []
+
+    async def locate(self, address):
+        self.requested.append(address)
+        return FOUND
+
+
+class SnapshotDiffTest(unittest.TestCase):
+    BASE = 'база.xlsx'
+    # Прошлая версия базы
+    PREVIOUS = {
+        'Ленина 1': (1.0, 1.0, 'exact'),
+        'Ленина 3': (3.0, 3.0, 'exact'),
+        'Ленина 5': (5.0, 5.0, 'exact'),
+        'Мира 2': (2.0, 2.0, 'exact'),
+        'Мира 4': (4.0, 4.0, 'exact'),
+    }
+    # Новая версия: адрес, координаты в файле, ожидаемые координаты и запрос к геокодеру
+    ROWS = [
+        ('Ленина 1', (1.0, 1.0), (1.0, 1.0), False),    # не изменилась
+        ('Садовая 7', None, FOUND[:2], True),           # новая строка
+        ('Садовая 9', (3.0, 3.0), FOUND[:2], True),     # адрес изменён на неизвестный
+        ('Ленина 5', (3.0, 3.0), (5.0, 5.0), False),    # адрес изменён на известный ('Ленина 3' -> 'Ленина 5')
+        ('Мира 4', (2.0, 2.0), (4.0, 4.0), False),      # строки поменялись адресами
+        ('Мира 2', (4.0, 4.0), (2.0, 2.0), False),
+        ('Тверская 8', (8.0, 8.0), (8.0, 8.0), False),  # координаты неизвестного происхождения
+    ]
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.directory = tempfile.mkdtemp(prefix='excel_geocoder_test_')
+        os.chdir(self.directory)
+        BaseSnapshots.shared = BaseSnapshots(os.path.join(self.directory, 'snapshots.sqlite3'))
+        CheckpointStore.shared = CheckpointStore(os.path.join(self.directory, 'checkpoints.sqlite3'))
+        BaseSnapshots.shared.replace(self.BASE, 'previous', {
+            address_fingerprint(address): value for address, value in self.PREVIOUS.items()
+        })
+
+    def tearDown(self):
+        BaseSnapshots.close_shared()
+        CheckpointStore.close_shared()
+        os.chdir(self.cwd)
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def process(self, streaming, write=True):
+        if write:
+            pd.DataFrame({
+                'Адрес': [address for address, _, _, _ in self.ROWS],
+                'Широта': [point[0] if point else None for _, point, _, _ in self.ROWS],
+                'Долгота': [point[1] if point else None for _, point, _, _ in self.ROWS],
+            }).to_excel('book.xlsx', index=False)
+        geocoder = StubGeocoder()
+        stats = asyncio.run(geocode_file('book.xlsx', geocoder, export=True, streaming=streaming, base=self.BASE))
+        return stats, geocoder.requested, pd.read_excel('book.xlsx')
+
+    def check(self, streaming):
+        stats, requested, dataframe = self.process(streaming)
+        self.assertEqual(sorted(requested), sorted(address for address, _, _, lookup in self.ROWS if lookup))
+        self.assertEqual(stats['changed'], 4)
+        self.assertEqual(stats['copied'], 0)
+        for (address, point, expected, _), (_, row) in zip(self.ROWS, dataframe.iterrows()):
+            self.assertEqual((row['Широта'], row['Долгота']), expected, address)
+            # Статус получают только строки, чьи координаты записаны этим запуском
+            if point != expected:
+                self.assertEqual(row['Статус'], 'ok', address)
+
+        # Снимок заменён этой версией: повторный запуск ничего не меняет и не запрашивает
+        snapshot = BaseSnapshots.open().load(self.BASE)
+        self.assertEqual(snapshot[address_fingerprint('Мира 4')][:2], (4.0, 4.0))
+        stats, requested, _ = self.process(streaming, write=False)
+        self.assertEqual((stats['changed'], stats['copied'], requested), (0, 0, []))
+
+    def test_pandas(self):
+        self.check(streaming=False)
+
+    def test_streaming(self):
+        self.check(streaming=True)
+
+
+if __name__ == '__main__':
+    unittest.main()